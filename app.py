@@ -15,12 +15,28 @@ from telegram.ext import JobQueue
 from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 
-from db import User, Message, Database
+from db import User, Database, after_fork
+
+try:
+    # Only available when running under uwsgi
+    from uwsgidecorators import postfork
+except ImportError:
+    def postfork(f):
+        return f
 
 app = Flask(__name__)
 db = Database()
+db.check_schema()
 beneficiary_bot.setup_state_machines()
 
+
+@postfork
+def reset_db_after_fork():
+    # uwsgi imports this module once and then forks the workers, which must
+    # not share the connections opened above
+    after_fork()
+
+
 # TODO: Move to a stub somehwere
 class FakeContext(object):
     def __init__(self):
@@ -142,6 +158,17 @@ def crossdomain(debug=False, origin=None, methods=None, headers=None, max_age=21
     return decorator
 
 
+@app.before_request
+def check_for_content_changes():
+    beneficiary_bot.reload_state_machines_if_changed()
+
+
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    # Each request thread gets its own session; give it back when done
+    db.remove_session()
+
+
 @app.route('/')
 def homepage():
     return render_template('index.html')
@@ -249,14 +276,8 @@ def show_user_messages(chat_id):
             'text': m.msg,
             'server_time': m.server_time
         }
-        for m in db.session.query(
-            Message.id,
-            Message.source,
-            Message.chat_id,
-            Message.msg,
-            Message.state,
-            Message.server_time
-        ).filter(Message.chat_id == chat_id)],
+        # Includes messages that have been moved to the archive tables
+        for m in db.message_history(chat_id)],
         default=json_serial)
 
 
@@ -3,14 +3,18 @@ import os
 import glob
 from datetime import datetime, timedelta
 import logging
+import re
+import threading
+import time
 
 from simple_settings import settings
 
 import nurse_bot
-from customnlu import interpreter, Intent, get_intent
-from db import Database, User, Message, Escalation
+import outbox
+from customnlu import Intent, parse_input
+from db import Database, Escalation
 from send import send_text_reply, send_image_reply, _log_msg
-from state_machine import StateMachine
+from state_machine import StateMachineRegistry
 
 
 # CONFUSED_MSG1 = "Hmm, I didn't quite understand what you're trying to say. Please try again"
@@ -40,36 +44,131 @@ logger = logging.getLogger(__name__)
 #################################################
 # State machine helper fns
 #################################################
-#  TODO: get rid of this global statemachine
-sm6 = None
-sm12 = None
 custom_gm_map_en = {}
 custom_gm_map_hi = {}
 custom_gm_map_imgs = {}
 
+# Hot reloading of the flows/translations. Handlers look up their state
+# machine when they need it, so swapping machines in the registry lets
+# in-flight requests finish on the machine they already hold.
+_reload_lock = threading.Lock()
+_loaded_fingerprint = None
+_failed_fingerprint = None
+_last_reload_check = 0
+
 
 def setup_state_machines():
-    global sm6, sm12
-    sm6 = StateMachine(settings.FLOW_6_MONTHS, settings.TRANSLATIONS_6_MONTHS)
-    sm12 = StateMachine(settings.FLOW_12_MONTHS,
-                        settings.TRANSLATIONS_12_MONTHS)
-    _load_custom_gm(settings.GM_FOLDER)
+    """Hook up the state machine registry. Tracks are loaded lazily, the
+    first time a user on that track needs one, but the state ids are needed
+    to read any user so they are loaded now."""
+    global custom_gm_map_en, custom_gm_map_hi, custom_gm_map_imgs
+    global _loaded_fingerprint
+    Database().load_state_ids()
+    StateMachineRegistry().prepare = _prepare_state_machine
+    _loaded_fingerprint = _content_fingerprint()
+    custom_gm_map_en, custom_gm_map_hi, custom_gm_map_imgs = _load_custom_gm(
+        settings.GM_FOLDER)
+
+
+def _content_files():
+    return StateMachineRegistry().source_files() + \
+        sorted(glob.glob(os.path.join(settings.GM_FOLDER, '*.csv')))
+
+
+def _content_fingerprint():
+    fingerprint = []
+    for filename in _content_files():
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        fingerprint.append((filename, st.st_mtime_ns, st.st_size))
+    return fingerprint
+
+
+def _prepare_state_machine(track, sm):
+    max_module = settings.MAX_MODULE_6 if int(
+        track) == 6 else settings.MAX_MODULE_12
+    demo_menu = DEMO_6_MONTH_MENU if int(
+        track) == 6 else DEMO_12_MONTH_MENU
+    for state_name in [GLOBAL_MAIN_MENU_STATE, demo_menu]:
+        sm.get_state_id_from_state_name(state_name)
+    for module in range(1, max_module + 1):
+        try:
+            sm.get_submodule_state_name(f'1_{module}_')
+        except IndexError:
+            raise ValueError(
+                f'No submodule menu for module {module} in track {track}')
+
+    # Users may be moved into these states as soon as the machine is used
+    Database().intern_states(sm.get_state_ids())
+    # Kept on the machine so they go away when it is reloaded or evicted
+    sm.compiled_templates = {msg: compile_template(msg)
+                             for msg in sm.get_all_messages()}
+
+
+def reload_state_machines():
+    """Rebuild the loaded state machines and custom GM content from disk and
+    swap them in. The old ones stay in place if the new content fails to
+    load or validate. Returns True if the new content was installed."""
+    global custom_gm_map_en, custom_gm_map_hi, custom_gm_map_imgs
+    global _loaded_fingerprint, _failed_fingerprint
+    with _reload_lock:
+        fingerprint = _content_fingerprint()
+        try:
+            gm_maps = _load_custom_gm(settings.GM_FOLDER)
+            StateMachineRegistry().reload()
+        except Exception:
+            logger.exception('Unable to reload flows, keeping the old ones')
+            _failed_fingerprint = fingerprint
+            return False
+        custom_gm_map_en, custom_gm_map_hi, custom_gm_map_imgs = gm_maps
+        _loaded_fingerprint = fingerprint
+        logger.warning('Reloaded flows and translations')
+        return True
+
+
+def reload_state_machines_if_changed(throttle=True):
+    """Cheap check (a few stats, at most every CONTENT_RELOAD_INTERVAL_SECONDS
+    unless throttle is False) that kicks off a background reload if any
+    content file changed."""
+    global _last_reload_check
+    now = time.monotonic()
+    if not settings.CONTENT_RELOAD_INTERVAL_SECONDS or (
+            throttle and now - _last_reload_check < settings.CONTENT_RELOAD_INTERVAL_SECONDS):
+        return False
+    _last_reload_check = now
+
+    if settings.STATE_MACHINE_IDLE_EVICT_SECONDS:
+        StateMachineRegistry().evict_idle(
+            settings.STATE_MACHINE_IDLE_EVICT_SECONDS)
+
+    fingerprint = _content_fingerprint()
+    if fingerprint in (_loaded_fingerprint, _failed_fingerprint) or _reload_lock.locked():
+        return False
+    logger.info('Content files changed, reloading in the background')
+    threading.Thread(target=reload_state_machines, daemon=True).start()
+    return True
+
+
+def check_for_content_changes(context):
+    """JobQueue callback for the telegram bot. The job already runs every
+    CONTENT_RELOAD_INTERVAL_SECONDS, so it isn't throttled again (a tick
+    that came a little early would otherwise be skipped)."""
+    reload_state_machines_if_changed(throttle=False)
 
 
 def _load_custom_gm(folder):
-    start_dir = os.getcwd()
-    os.chdir(folder)
-    for _, csv_file in enumerate(glob.glob("*.csv")):
+    gm_map_en, gm_map_hi, gm_map_imgs = {}, {}, {}
+    for csv_file in sorted(glob.glob(os.path.join(folder, '*.csv'))):
         logger.info(f'Opening custom GM file {csv_file}')
-        with open(csv_file, 'r',encoding='utf-8-sig') as f:
+        with open(csv_file, 'r', encoding='utf-8-sig') as f:
             csv_rdr = csv.DictReader(f)
             for row in csv_rdr:
-                custom_gm_map_en[row['telegram_id']] = row['english']
-                custom_gm_map_hi[row['telegram_id']] = row['hindi']
-                custom_gm_map_imgs[row['telegram_id']] = row['image']
-
-    # Reset the working director
-    os.chdir(start_dir)
+                gm_map_en[row['telegram_id']] = row['english']
+                gm_map_hi[row['telegram_id']] = row['hindi']
+                gm_map_imgs[row['telegram_id']] = row['image']
+    return gm_map_en, gm_map_hi, gm_map_imgs
 
 
 def replace_custom_message(msgs, imgs, context):
@@ -86,9 +185,7 @@ def replace_custom_message(msgs, imgs, context):
 
 
 def get_sm_from_track(track):
-    if int(track) == 12:
-        return sm12
-    return sm6
+    return StateMachineRegistry().get(track)
 
 
 def _get_sm_from_context(context):
@@ -99,7 +196,7 @@ def _get_sm_from_context(context):
 # State handling
 #################################################
 def fetch_user_data(chat_id, context):
-    user = Database().session.query(User).filter_by(chat_id=str(chat_id)).first()
+    user = Database().get_user(chat_id)
     if user:
         # https://stackoverflow.com/questions/38987/how-to-merge-two-dictionaries-in-a-single-expression
         logger.info(f'found info for {chat_id}, {user.to_dict()}')
@@ -129,10 +226,7 @@ def get_chat_id(update, context):
 
 def _save_user_state(chat_id, state_id, state_name):
     logger.info(f'setting state to {state_name} for {chat_id}')
-    our_user = Database().session.query(User).filter_by(chat_id=str(chat_id)).first()
-    our_user.current_state = state_id
-    our_user.current_state_name = state_name
-    Database().commit()
+    Database().set_user_state(chat_id, state_id, state_name)
 
 
 def _get_menu_for_user(context):
@@ -188,8 +282,8 @@ def timeout(context):
     _log_msg(msg_txt, 'system-timeout', None,
              state=prior_state,
              chat_id=str(chat_id))
-    context.bot.send_message(
-        chat_id, msg_txt)
+    outbox.send_message(
+        context.bot, chat_id, msg_txt)
 
 
 def remove_old_timer_add_new(context):
@@ -206,19 +300,50 @@ def remove_old_timer_add_new(context):
 #################################################
 # Message sending and prep
 #################################################
-def replace_template(msg, context):
-    repl = {
-        '[child name]': context.user_data['child_name'],
-        '[बच्चे का नाम]': context.user_data['child_name'],
-        '[AWW name]': context.user_data['aww'],
-        '[AWW नाम]': context.user_data['aww'],
-        '[mother name]': context.user_data['first_name'],
-        '[AWW phone number]': context.user_data['aww_number'],
-        '[AWW फोन नंबर]': context.user_data['aww_number'],
-    }
-    for initial, word in repl.items():
-        msg = msg.replace(initial, word)
-    return msg
+# Placeholders in the content and the user_data field that fills them in
+TEMPLATE_FIELDS = {
+    '[child name]': 'child_name',
+    '[बच्चे का नाम]': 'child_name',
+    '[AWW name]': 'aww',
+    '[AWW नाम]': 'aww',
+    '[mother name]': 'first_name',
+    '[AWW phone number]': 'aww_number',
+    '[AWW फोन नंबर]': 'aww_number',
+}
+TEMPLATE_RE = re.compile('|'.join(re.escape(p) for p in TEMPLATE_FIELDS))
+
+
+def compile_template(msg):
+    """Split msg into alternating literal text and user_data fields, i.e.
+    (text, field, text, field, ..., text)."""
+    parts = []
+    pos = 0
+    for m in TEMPLATE_RE.finditer(msg):
+        parts.append(msg[pos:m.start()])
+        parts.append(TEMPLATE_FIELDS[m.group()])
+        pos = m.end()
+    parts.append(msg[pos:])
+    return tuple(parts)
+
+
+def render_template(parts, user_data):
+    if len(parts) == 1:
+        return parts[0]
+    out = [parts[0]]
+    for i in range(1, len(parts), 2):
+        out.append(user_data[parts[i]])
+        out.append(parts[i + 1])
+    return ''.join(out)
+
+
+def replace_template(msg, context, sm=None):
+    """Fill in the user's details in msg. Content messages were compiled
+    when sm was loaded; anything else (nurse replies, reminders) is
+    compiled now."""
+    parts = sm and sm.compiled_templates.get(msg)
+    if not parts:
+        parts = compile_template(msg)
+    return render_template(parts, context.user_data)
 
 
 def prepend_img_path(img):
@@ -239,8 +364,9 @@ def _log_and_fetch_user_data(update, context):
     logger.info(
         f'fetched the following: {current_state_id}, {current_state_name}')
     _log_msg(update.message.text, 'user', update, state=current_state_name)
+    parsed = parse_input(update)
     logger.warn(
-        f'[{get_chat_id(update, context)}] - intent: {get_intent(update.message.text)} msg received: {update.message.text}')
+        f'[{get_chat_id(update, context)}] - intent: {parsed.intent} ({parsed.latency_ms:.3f} ms) msg received: {update.message.text}')
     return current_state_id, current_state_name
 
 
@@ -253,7 +379,8 @@ def _save_state_and_process(update, context, msgs, imgs, state_id, state_name):
     # logger.info(f'[{update.effective_chat.id}] - next state: {state.msg_id}')
     context.user_data['current_state'] = state_id
     _save_user_state(update.effective_chat.id, state_id, state_name)
-    msgs = [replace_template(m, context) for m in msgs]
+    sm = _get_sm_from_context(context)
+    msgs = [replace_template(m, context, sm) for m in msgs]
     for msg in msgs:
         send_text_reply(msg, update)
     if imgs:
@@ -281,7 +408,7 @@ def _escalate_to_nurse(update, context):
 
 
 def _handle_echo(update, context):
-    intent = get_intent(update.message.text)
+    intent = parse_input(update).intent
 
     if intent == Intent.UNKNOWN or (int(intent) < 1 or int(intent) > 10):
         if settings.HINDI:
@@ -305,7 +432,8 @@ def _handle_global_reset(update, context):
     msgs, imgs, state_id, state_name = _get_menu_for_user(context)
     _save_user_state(update.effective_chat.id,
                      state_id, state_name)
-    msgs = [replace_template(m, context) for m in msgs]
+    sm = _get_sm_from_context(context)
+    msgs = [replace_template(m, context, sm) for m in msgs]
     for msg in msgs:
         send_text_reply(msg, update)
     if imgs:
@@ -337,7 +465,7 @@ def _handle_wrong_input(update, context):
 
 
 def _handle_global_menu_input(update, context):
-    intent = get_intent(update.message.text)
+    intent = parse_input(update).intent
     max_module = settings.MAX_MODULE_6 if int(
         context.user_data['track']) == 6 else settings.MAX_MODULE_12
     gm_module = settings.GM_MODULE_6 if int(
@@ -366,7 +494,7 @@ def _handle_valid_input(update, context):
 
     # Get the correct state machine
     sm = _get_sm_from_context(context)
-    intent = get_intent(update.message.text)
+    intent = parse_input(update).intent
 
     try:
         msgs, imgs, state_id, state_name, terminal = sm.get_msg_and_next_state(
@@ -403,7 +531,7 @@ def process_user_input(update, context):
     remove_old_timer_add_new(context)
 
     # Handle global reset
-    intent = get_intent(update.message.text)
+    intent = parse_input(update).intent
     # if intent == Intent.GREET or intent == Intent.RESTART:
     if intent == Intent.GREET:
         logger.info(
@@ -1,10 +1,52 @@
 from enum import IntEnum, unique
-from rasa_nlu.model import Interpreter
+import threading
+import time
+import unicodedata
+
 from simple_settings import settings
 
 from nlu_data import NUMBERS
+
 # where model_directory points to the model folder
-interpreter = Interpreter.load('models/current/nlu')
+NLU_MODEL_DIR = 'models/current/nlu'
+
+# The Rasa interpreter drags in TensorFlow, so it is only loaded the first
+# time get_rasa_intent needs it (or in the background by preload_interpreter).
+_interpreter = None
+_interpreter_lock = threading.Lock()
+
+
+def get_interpreter():
+    global _interpreter
+    if _interpreter is None:
+        with _interpreter_lock:
+            if _interpreter is None:
+                from rasa_nlu.model import Interpreter
+                _interpreter = Interpreter.load(NLU_MODEL_DIR)
+    return _interpreter
+
+
+_ngram_classifier = None
+
+
+def get_ngram_classifier():
+    global _ngram_classifier
+    if _ngram_classifier is None:
+        with _interpreter_lock:
+            if _ngram_classifier is None:
+                from ngram_nlu import CharNgramClassifier
+                _ngram_classifier = CharNgramClassifier.load(
+                    settings.NLU_NGRAM_MODEL)
+    return _ngram_classifier
+
+
+def preload_interpreter():
+    """Start loading the interpreter in a background thread so the first
+    get_rasa_intent call doesn't have to wait for it."""
+    target = get_interpreter
+    if settings.NLU_CLASSIFIER == 'ngram':
+        target = get_ngram_classifier
+    threading.Thread(target=target, daemon=True).start()
 
 
 @unique
@@ -40,9 +82,37 @@ ENTITY_MAP = {
 }
 
 
+def get_ngram_intents(msgs):
+    """Classify a batch of messages with the n-gram classifier, with the
+    same contract as get_rasa_intent. Messages the model labels out of
+    scope, or can't separate between two intents, are UNKNOWN."""
+    intents = []
+    for label, confidence in get_ngram_classifier().predict_batch(
+            msgs, settings.NLU_NGRAM_MIN_MARGIN):
+        if label is None or confidence < settings.NLU_THRESHOLD:
+            intents.append(Intent.UNKNOWN)
+        else:
+            intents.append(_label_to_intent(label))
+    return intents
+
+
 def get_rasa_intent(msg):
-    result = interpreter.parse(msg)
+    if settings.NLU_SERVICE_WORKERS:
+        # Keep the model out of this process (and off the dispatcher thread)
+        import nlu_service
+        return nlu_service.get_client().classify(msg)
+    return classify_batch([msg])[0]
 
+
+def classify_batch(msgs):
+    """Run the configured classifier over msgs in this process."""
+    if settings.NLU_CLASSIFIER == 'ngram':
+        return get_ngram_intents(msgs)
+    interpreter = get_interpreter()
+    return [_rasa_result_to_intent(interpreter.parse(msg)) for msg in msgs]
+
+
+def _rasa_result_to_intent(result):
     # A bit of a cheat, but we'll take entities over anything
     if len(result['entities']) > 0:
         try:
@@ -68,21 +138,186 @@ def get_rasa_intent(msg):
     return Intent.UNKNOWN
 
 
+def _osa_distance(a, b):
+    # Levenshtein plus swapping two adjacent characters ("tow" -> "two")
+    d = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in range(len(a) + 1):
+        d[i][0] = i
+    for j in range(len(b) + 1):
+        d[0][j] = j
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            d[i][j] = min(d[i - 1][j] + 1,
+                          d[i][j - 1] + 1,
+                          d[i - 1][j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d[i][j] = min(d[i][j], d[i - 2][j - 2] + 1)
+    return d[len(a)][len(b)]
+
+
+def _deletions(word, max_distance):
+    """word plus every string made by deleting up to max_distance chars."""
+    variants = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        variants |= frontier
+    return variants
+
+
+class FuzzyIndex(object):
+    """Finds the words within max_distance edits of a query without
+    comparing it against the whole vocabulary ("symmetric delete"): two
+    words within k edits of each other always share a string that can be
+    reached by deleting at most k characters from each. Those deletions are
+    indexed up front, so a lookup is a handful of dict hits plus an exact
+    distance check on the few candidates."""
+
+    def __init__(self, words, max_distance):
+        self.max_distance = max_distance
+        self.max_length = 0
+        self.index = {}
+        for word in words:
+            self.max_length = max(self.max_length, len(word))
+            for variant in _deletions(word, max_distance):
+                self.index.setdefault(variant, set()).add(word)
+
+    def search(self, word):
+        # Long free text (a question for the nurse) can't be a typo of any
+        # word, so don't spend time generating its deletions.
+        if len(word) > self.max_length + self.max_distance:
+            return []
+        candidates = set()
+        for variant in _deletions(word, self.max_distance):
+            candidates |= self.index.get(variant, set())
+        results = []
+        for candidate in candidates:
+            d = _osa_distance(word, candidate)
+            if d <= self.max_distance:
+                results.append((d, candidate))
+        return results
+
+
+def _normalize(sentence):
+    # Lowercase and collapse runs of whitespace ("नंबर  २" -> "नंबर २")
+    return ' '.join(sentence.lower().split())
+
+
+def _digits(sentence):
+    return [c for c in sentence if c.isdigit()]
+
+
+_NORMALIZED_NUMBERS = {_normalize(k): v for k, v in NUMBERS.items()}
+# Single characters ("1", "न") are too close to everything else to match
+# fuzzily, so they only ever match exactly.
+_FUZZY_INDEX = FuzzyIndex((k for k in _NORMALIZED_NUMBERS if len(k) > 1),
+                          settings.NLU_FUZZY_MAX_DISTANCE)
+
+
+def _is_swap(word, key):
+    # The same letters with two neighbours swapped ("tow" -> "two")
+    if len(word) != len(key):
+        return False
+    diffs = [i for i in range(len(word)) if word[i] != key[i]]
+    return (len(diffs) == 2 and diffs[1] == diffs[0] + 1
+            and word[diffs[0]] == key[diffs[1]] and word[diffs[1]] == key[diffs[0]])
+
+
+def _is_doubled(word, key):
+    # One letter typed twice ("yess" -> "yes")
+    return len(word) == len(key) + 1 and any(
+        word[i] == word[i + 1] and word[:i] + word[i + 1:] == key
+        for i in range(len(word) - 1))
+
+
+def _is_mark_variant(word, key):
+    # One vowel sign or nasal mark for another ("पाँच" -> "पांच")
+    if len(word) != len(key):
+        return False
+    diffs = [i for i in range(len(word)) if word[i] != key[i]]
+    return len(diffs) == 1 and all(
+        unicodedata.category(c[diffs[0]]).startswith('M') for c in (word, key))
+
+
+def _is_plausible_typo(word, key):
+    """Whether word, within NLU_FUZZY_MAX_DISTANCE edits of key, looks like
+    a typo of it rather than some other word. Short words are one edit from
+    too many ordinary ones ("for" -> four, "nice" -> nine, "tree" -> three),
+    so below NLU_FUZZY_EDIT_LENGTH only swapped or doubled letters (and
+    Hindi vowel sign variants) count. Longer words can have any edits
+    except to the first or last letter ("night" -> eight, "fifty" -> fifth,
+    "seconds" -> second), which are rarely typos."""
+    if _is_swap(word, key) or _is_doubled(word, key) or _is_mark_variant(word, key):
+        return True
+    if len(word) < settings.NLU_FUZZY_EDIT_LENGTH:
+        return False
+    return word[0] == key[0] and word[-1] == key[-1]
+
+
+def _fuzzy_label(sentence):
+    max_distance = settings.NLU_FUZZY_MAX_DISTANCE
+    if not max_distance or len(sentence) < settings.NLU_FUZZY_MIN_LENGTH:
+        return None
+    matches = {}
+    for d, key in _FUZZY_INDEX.search(sentence):
+        # Never turn one number into another ("option 11" is not "option 1")
+        if _digits(key) == _digits(sentence) and _is_plausible_typo(sentence, key):
+            matches.setdefault(d, set()).add(_NORMALIZED_NUMBERS[key])
+    if not matches:
+        return None
+    labels = matches[min(matches)]
+    # Too close to two different intents ("tee": "teen" or "ten"?)
+    if len(labels) > 1:
+        return None
+    return labels.pop()
+
+
+def _label_to_intent(label):
+    if label == 'greet':
+        return Intent.GREET
+    elif label == 'yes':
+        return Intent.YES
+    elif label == 'no':
+        return Intent.NO
+    elif label == 'restart':
+        return Intent.RESTART
+    return ENTITY_MAP.get(label, Intent.UNKNOWN)
+
+
 def get_intent(sentence):
-    # Doing an exact match right now.
-    # Could imagine doing a leviathan distance thing instead to make it
-    # slightly more flexible, but that seems unnecessary for now
+    # Exact match first, which is what almost every message hits. Then
+    # ignore extra whitespace, and finally allow a small edit distance for
+    # typos (see NLU_FUZZY_MAX_DISTANCE).
     sentence = sentence.strip().lower()
-    if sentence in NUMBERS.keys():
-        if NUMBERS[sentence] == 'greet':
-            return Intent.GREET
-        elif NUMBERS[sentence] == 'yes':
-            return Intent.YES
-        elif NUMBERS[sentence] == 'no':
-            return Intent.NO
-        return ENTITY_MAP[NUMBERS[sentence]]
+    label = NUMBERS.get(sentence)
+    if label is None:
+        sentence = _normalize(sentence)
+        label = _NORMALIZED_NUMBERS.get(sentence) or _fuzzy_label(sentence)
+    if label is None:
+        return Intent.UNKNOWN
+    return _label_to_intent(label)
 
-    return Intent.UNKNOWN
+
+class ParsedInput(object):
+    """The intent for one incoming message, along with how long it took to
+    classify (for the logs)."""
+
+    def __init__(self, text):
+        start = time.perf_counter()
+        self.text = text
+        self.intent = get_intent(text)
+        self.latency_ms = (time.perf_counter() - start) * 1000
+
+
+def parse_input(update):
+    """Classify update.message.text once per update. Every later call for
+    the same update gets the same ParsedInput back."""
+    parsed = getattr(update, 'parsed_input', None)
+    if parsed is None or parsed.text != update.message.text:
+        parsed = ParsedInput(update.message.text)
+        update.parsed_input = parsed
+    return parsed
 
 
 def test_nlu_loop():
@@ -91,7 +326,7 @@ def test_nlu_loop():
     while sentence != '-1':
         print(f'STRICT Intent result: {get_intent(sentence)}')
         # print(f'Intent result: {get_intent(sentence)}')
-        # print(interpreter.parse(sentence))
+        # print(get_interpreter().parse(sentence))
         sentence = input(
             'Enter a sentence and I will tell you the intent (-1 or ctrl-c to quit):\n')
 
@@ -1,14 +1,67 @@
-from datetime import datetime
+import argparse
+import atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import io
+import logging
+import os
+import re
+import threading
+import time
 
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, create_engine
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy import (Column, Integer, String, Boolean, DateTime, ForeignKey, Index, MetaData, Table,
+                        column, create_engine, event, func, inspect, select, union_all)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.declarative import declarative_base
 
 from simple_settings import settings
 from util import Singleton
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
+# current_state values that are not states in any flow
+SPECIAL_STATES = ['', 'echo', 'all_done_id']
+
+# In-memory copy of the state_ids table, loaded by Database.intern_states
+_state_ids = {}
+_state_strs = {}
+
+
+class InternedState(TypeDecorator):
+    """Stores a state id (a flow UUID or one of SPECIAL_STATES) as a small
+    integer from the state_ids table. Only for databases created with
+    DB_INTEGER_STATE_IDS on (see Database.check_state_column)."""
+    impl = Integer
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return _state_ids[value]
+        except KeyError:
+            raise ValueError(
+                f'State "{value}" has no integer id. Was it passed to Database().intern_states?')
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, str):
+            return value
+        return _state_strs.get(value, value)
+
+
+class StateId(Base):
+    __tablename__ = 'state_ids'
+
+    id = Column(Integer, primary_key=True)
+    state = Column(String, unique=True, nullable=False)
+
 
 class Timeout(Base):
     __tablename__ = 'timeout_queue'
@@ -31,6 +84,14 @@ class Escalation(Base):
     escalated_time = Column(DateTime)
     replied_time = Column(DateTime)
 
+    __table_args__ = (
+        # First pending escalation (the nurse queue)
+        Index('ix_nurse_queue_pending_escalated_time',
+              'pending', 'escalated_time'),
+        # Marking a user's escalations as answered
+        Index('ix_nurse_queue_chat_src_id_pending', 'chat_src_id', 'pending'),
+    )
+
 # TODO: Should the primary key be the chat_id?
 # TODO: Should we get rid of the linking between User and Message? We don't
 # use it aywhere and I'm a bit nervous using it would do unpredictable things
@@ -46,12 +107,15 @@ class User(Base):
     track = Column(String)
     aww = Column(String)
     aww_number = Column(String)
-    awc_code = Column(String)
+    awc_code = Column(String, index=True)
     child_name = Column(String)
     child_gender = Column(String(1))
     child_birthday = Column(DateTime)
     phone_number = Column(String)
-    current_state = Column(String)
+    # Set DB_INTEGER_STATE_IDS to store this as an integer instead of a
+    # 36 character UUID. Only do this on a new database.
+    current_state = Column(
+        InternedState if settings.DB_INTEGER_STATE_IDS else String)
     current_state_name = Column(String)
     registration_date = Column(DateTime)
     next_module = Column(Integer, default=1, nullable=False)
@@ -61,6 +125,12 @@ class User(Base):
 
     cohort = Column(Integer, default=-1, nullable=False)
 
+    __table_args__ = (
+        # Finding the users to send the next module to
+        Index('ix_users_cohort_test_user_track_next_module',
+              'cohort', 'test_user', 'track', 'next_module'),
+    )
+
     messages = relationship(
         'Message', order_by='Message.server_time', back_populates='user')
 
@@ -83,44 +153,578 @@ class Message(Base):
 
     user = relationship('User', back_populates='messages')
 
+    __table_args__ = (
+        # A chat's messages in order (the API)
+        Index('ix_messages_chat_id_server_time', 'chat_id', 'server_time'),
+    )
+
+
+class TelegramFile(Base):
+    """The file_id Telegram gave an image we uploaded, so it can be sent
+    again without uploading it. Keyed by the file's content as well as its
+    path, so an edited image gets uploaded again."""
+    __tablename__ = 'telegram_files'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False)
+    sha256 = Column(String, nullable=False)
+    file_id = Column(String, nullable=False)
+    upload_time = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_telegram_files_path_sha256', 'path', 'sha256', unique=True),
+    )
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+    applied_time = Column(DateTime)
+
+
+# Messages older than MESSAGE_ARCHIVE_AFTER_DAYS are moved to one table per
+# month (messages_YYYY_MM) by Database.archive_messages. These aren't part
+# of Base, so create_all leaves them alone.
+archive_metadata = MetaData()
+ARCHIVE_TABLE_RE = re.compile(r'^messages_(\d{4})_(\d{2})$')
+_archive_lock = threading.Lock()
+
+
+def message_archive_table(year, month):
+    name = f'messages_{year:04d}_{month:02d}'
+    with _archive_lock:
+        if name in archive_metadata.tables:
+            return archive_metadata.tables[name]
+        return Table(name, archive_metadata,
+                     *[Column(c.name, c.type, primary_key=c.primary_key)
+                       for c in Message.__table__.columns],
+                     Index(f'ix_{name}_chat_id_server_time', 'chat_id', 'server_time'))
+
 
 # Lots of people have lots of opinions on Singletons. This is research code,
 # let's not get righteous.
 class Database(metaclass=Singleton):
     def __init__(self):
         # self.engine = create_engine('sqlite:///:memory:')
-        self.engine = create_engine(settings.DB_SQLALCHEMY_CONNECTION)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
-        self.reset_db()
+        self.engine = create_engine(settings.DB_SQLALCHEMY_CONNECTION,
+                                    **_engine_options(settings.DB_SQLALCHEMY_CONNECTION))
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', _set_sqlite_pragmas)
+        event.listen(self.engine, 'connect', _record_pid)
+        event.listen(self.engine, 'checkout', _check_pid)
+        # Pools inherited from the parent process, see after_fork
+        self._parent_pools = []
+        # Objects keep their loaded values after their unit of work has
+        # committed, so handlers can keep reading them.
+        self.session_factory = sessionmaker(
+            bind=self.engine, expire_on_commit=False)
+        # One session per thread (dispatcher workers, the job queue, Flask
+        # requests). Database().session.query(...) uses the calling thread's.
+        self.session = scoped_session(self.session_factory)
+        self._local = threading.local()
+        # chat_id -> (detached User, time it was read), least recently used
+        # first. See get_user.
+        self._users = OrderedDict()
+        self._users_lock = threading.Lock()
+        self._users_generation = 0
+        # See archive_tables
+        self._archive_tables = None
+        self._archive_tables_time = 0
+
+    @contextmanager
+    def session_scope(self):
+        """A unit of work on this thread's session: commits when the block
+        finishes, rolls back if it raises, and then releases the session.
+        Nested scopes join the outermost one, which does the commit."""
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        session = self.session()
+        try:
+            yield session
+            if depth == 0:
+                session.commit()
+        except:
+            if depth == 0:
+                session.rollback()
+            raise
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self.session.remove()
+
+    def after_fork(self):
+        """Called in a forked child (e.g. a uwsgi worker). Starts a new
+        connection pool and new sessions for this process. The parent's
+        connections are kept around but never used: closing them here would
+        close them for the parent too."""
+        self._parent_pools.append(self.engine.pool)
+        self.engine.pool = self.engine.pool.recreate()
+        self.session = scoped_session(self.session_factory)
+        self._local = threading.local()
+        self._users_lock = threading.Lock()
+
+    def remove_session(self):
+        self.session.remove()
 
     def commit(self):
         self.session.commit()
 
     def reset_db(self):
-        Base.metadata.create_all(self.engine)
+        self.migrate()
+
+    def schema_version(self):
+        if not self.engine.has_table(SchemaVersion.__tablename__):
+            return 0
+        with self.engine.connect() as conn:
+            return conn.execute(select([func.max(SchemaVersion.version)])).scalar() or 0
+
+    def check_schema(self):
+        """Cheap startup check that `python db.py migrate` has been run for
+        this version of the code."""
+        version = self.schema_version()
+        if version < SCHEMA_VERSION:
+            raise RuntimeError(
+                f'The database schema is at version {version}, but this code needs version '
+                f'{SCHEMA_VERSION}. Run `python db.py migrate` first.')
+        if version > SCHEMA_VERSION:
+            logger.warning(
+                f'The database schema (version {version}) is newer than this code (version {SCHEMA_VERSION})')
+        self.check_state_column()
+
+    def check_state_column(self):
+        """Refuse to start when DB_INTEGER_STATE_IDS doesn't match how
+        users.current_state was created. Flipping the setting on an existing
+        database would otherwise store ids as text (or states as numbers)
+        and read back the wrong states."""
+        columns = {c['name']: c['type']
+                   for c in inspect(self.engine).get_columns(User.__tablename__)}
+        is_integer = isinstance(columns['current_state'], Integer)
+        if is_integer != bool(settings.DB_INTEGER_STATE_IDS):
+            raise RuntimeError(
+                f'users.current_state is stored as {columns["current_state"]}, but '
+                f'DB_INTEGER_STATE_IDS is {settings.DB_INTEGER_STATE_IDS}. The setting '
+                f'can only be changed on a new database.')
+
+    def migrate(self):
+        """Run the MIGRATIONS the database hasn't had yet. This is the only
+        place that changes the schema; run it once per deploy rather than
+        from every process."""
+        version = self.schema_version()
+        for target, description, step in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.warning(f'Migrating the database to version {target}: {description}')
+            step(self)
+            with self.engine.begin() as conn:
+                conn.execute(SchemaVersion.__table__.insert(),
+                             version=target, applied_time=datetime.utcnow())
+            version = target
+        return version
+
+    def create_missing_indexes(self):
+        """create_all skips tables that already exist, so indexes added to
+        the models later have to be created here. Safe to run repeatedly."""
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    logger.info(f'Creating index {index.name} on {table.name}')
+                    index.create(self.engine)
+
+    def load_state_ids(self):
+        """Load the full state_ids mapping into memory. Must happen before
+        users are read or written, since a row's state is only an integer
+        until the mapping is loaded. Only needed with DB_INTEGER_STATE_IDS."""
+        self.intern_states(SPECIAL_STATES)
+
+    def intern_states(self, states):
+        """Make sure every state in states has an integer id and load the
+        full mapping into memory. Only needed with DB_INTEGER_STATE_IDS."""
+        global _state_ids, _state_strs
+        if not settings.DB_INTEGER_STATE_IDS:
+            return
+        with self.session_scope() as session:
+            known = {row.state: row.id for row in session.query(StateId)}
+            missing = set(states).union(SPECIAL_STATES) - set(known)
+            if missing:
+                # Other processes may be loading the same flow right now
+                session.execute(_insert_ignoring_duplicates(StateId.__table__, session),
+                                [{'state': state} for state in sorted(missing)])
+                known = {row.state: row.id for row in session.query(StateId)}
+        # Other threads use the mapping meanwhile, so swap in new dicts
+        # rather than emptying and refilling these
+        _state_ids = known
+        _state_strs = {v: k for k, v in known.items()}
+
+    def get_user(self, chat_id):
+        """The User for chat_id, or None. Outside a unit of work this is a
+        read-only copy that may come from the cache, which is kept up to date
+        by set_user_state. Anything else that changes users must call
+        invalidate_users. Other processes' changes are picked up after
+        USER_CACHE_SECONDS."""
+        chat_id = str(chat_id)
+        with self._users_lock:
+            entry = self._users.get(chat_id)
+            if entry and time.monotonic() - entry[1] < settings.USER_CACHE_SECONDS:
+                self._users.move_to_end(chat_id)
+                return entry[0]
+            generation = self._users_generation
+        # Inside someone else's unit of work the User belongs to their
+        # session, so it can't be shared
+        cacheable = settings.USER_CACHE_SIZE and not getattr(self._local, 'depth', 0)
+        with self.session_scope() as session:
+            user = session.query(User).filter_by(chat_id=chat_id).first()
+        if user is not None and cacheable:
+            with self._users_lock:
+                # Skip it if a write happened while we were reading
+                if generation == self._users_generation:
+                    self._users[chat_id] = (user, time.monotonic())
+                    self._users.move_to_end(chat_id)
+                    while len(self._users) > settings.USER_CACHE_SIZE:
+                        self._users.popitem(last=False)
+        return user
+
+    def set_user_state(self, chat_id, state_id, state_name):
+        chat_id = str(chat_id)
+        nested = getattr(self._local, 'depth', 0)
+        with self.session_scope() as session:
+            session.query(User).filter_by(chat_id=chat_id).update(
+                {'current_state': state_id, 'current_state_name': state_name})
+        with self._users_lock:
+            self._users_generation += 1
+            entry = self._users.get(chat_id)
+            if entry and nested:
+                # Not committed yet, so the caller might still roll back
+                del self._users[chat_id]
+            elif entry:
+                set_committed_value(entry[0], 'current_state', state_id)
+                set_committed_value(entry[0], 'current_state_name', state_name)
+
+    def iter_user_chunks(self, criterion, chunk_size=None):
+        """Yield the Users matching criterion in lists of chunk_size, in id
+        order. Each chunk is read in its own short transaction, so the
+        caller can write between chunks (the read cursor isn't held open
+        like with yield_per) and the chunks are stable even if the writes
+        change whether rows match criterion."""
+        chunk_size = chunk_size or settings.DB_CHUNK_SIZE
+        last_id = 0
+        while True:
+            with self.session_scope() as session:
+                chunk = session.query(User).filter(
+                    criterion, User.id > last_id).order_by(User.id).limit(chunk_size).all()
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk[-1].id
+
+    def archive_tables(self, refresh=False):
+        """The message archive tables that exist, oldest first. The list is
+        cached for MESSAGE_ARCHIVE_TABLES_CACHE_SECONDS, since archiving
+        usually happens in another process (the bot, not the web app)."""
+        now = time.monotonic()
+        if refresh or self._archive_tables is None or \
+                now - self._archive_tables_time >= settings.MESSAGE_ARCHIVE_TABLES_CACHE_SECONDS:
+            names = sorted(name for name in inspect(self.engine).get_table_names()
+                           if ARCHIVE_TABLE_RE.match(name))
+            self._archive_tables = [
+                message_archive_table(*map(int, ARCHIVE_TABLE_RE.match(name).groups()))
+                for name in names]
+            self._archive_tables_time = now
+        return self._archive_tables
+
+    def archive_messages(self, older_than_days=None):
+        """Move messages older than older_than_days (default
+        MESSAGE_ARCHIVE_AFTER_DAYS) to the archive table for their month,
+        one transaction per month. Returns how many were moved."""
+        if older_than_days is None:
+            older_than_days = settings.MESSAGE_ARCHIVE_AFTER_DAYS
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+        messages = Message.__table__
+        moved = 0
+        while True:
+            with self.engine.begin() as conn:
+                oldest = conn.execute(select([func.min(messages.c.server_time)]).where(
+                    messages.c.server_time < cutoff)).scalar()
+                if oldest is None:
+                    break
+                start = datetime(oldest.year, oldest.month, 1)
+                end = min(cutoff, datetime(start.year + start.month // 12,
+                                           start.month % 12 + 1, 1))
+                archive = message_archive_table(start.year, start.month)
+                archive.create(conn, checkfirst=True)
+                in_month = (messages.c.server_time >= start) & (messages.c.server_time < end)
+                conn.execute(archive.insert().from_select(
+                    [c.name for c in messages.columns], select([messages]).where(in_month)))
+                count = conn.execute(messages.delete().where(in_month)).rowcount
+            logger.info(f'Archived {count} messages to {archive.name}')
+            moved += count
+        if moved:
+            self.archive_tables(refresh=True)
+        return moved
+
+    def message_history(self, chat_id=None):
+        """Every message (for chat_id, if given) in server_time order,
+        including the archived ones. Use this instead of querying Message
+        when the full history is needed."""
+        selects = []
+        for table in [Message.__table__] + self.archive_tables():
+            query = select([table.c[c.name] for c in Message.__table__.columns])
+            if chat_id is not None:
+                query = query.where(table.c.chat_id == str(chat_id))
+            selects.append(query)
+        with self.engine.connect() as conn:
+            return conn.execute(union_all(*selects).order_by(
+                column('server_time'), column('id'))).fetchall()
+
+    def invalidate_users(self, chat_ids=None):
+        """Drop chat_ids (or every user) from the get_user cache."""
+        with self._users_lock:
+            self._users_generation += 1
+            if chat_ids is None:
+                self._users.clear()
+            else:
+                for chat_id in chat_ids:
+                    self._users.pop(str(chat_id), None)
 
     def get_state_name_from_chat_id(self, chat_id):
-        user = self.session.query(User).filter_by(chat_id=str(chat_id)).first()
+        user = self.get_user(chat_id)
         try:
             return user.current_state_name
         except AttributeError:
             return '<unregistered_user>'
 
     def insert(self, obj):
-        if type(obj) is list:
-            self.session.add_all(obj)
-        else:
-            self.session.add(obj)
-        self.session.commit()
+        with self.session_scope() as session:
+            if type(obj) is list:
+                session.add_all(obj)
+            else:
+                session.add(obj)
+
+    def insert_messages(self, messages):
+        """Insert many Message objects at once, without going through the
+        ORM (so the objects don't get their ids filled in)."""
+        columns = [c.name for c in Message.__table__.columns if c.name != 'id']
+        rows = [{name: getattr(msg, name) for name in columns} for msg in messages]
+        if not rows:
+            return
+        if self.engine.dialect.driver == 'psycopg2' and settings.DB_POSTGRES_COPY:
+            self._copy_rows(Message.__tablename__, columns, rows)
+            return
+        # One executemany (batched by psycopg2 with use_batch_mode)
+        with self.engine.begin() as conn:
+            conn.execute(Message.__table__.insert(), rows)
+
+    def _copy_rows(self, table_name, columns, rows):
+        buf = io.StringIO()
+        for row in rows:
+            buf.write('\t'.join(_copy_value(row[name]) for name in columns))
+            buf.write('\n')
+        buf.seek(0)
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(
+                f'COPY {table_name} ({", ".join(columns)}) FROM STDIN', buf)
+            cursor.close()
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def get_telegram_file_ids(self):
+        """{(path, sha256): file_id} for every image uploaded so far."""
+        with self.session_scope() as session:
+            return {(f.path, f.sha256): f.file_id for f in session.query(TelegramFile)}
+
+    def save_telegram_file_id(self, path, sha256, file_id):
+        with self.session_scope() as session:
+            session.query(TelegramFile).filter_by(path=path, sha256=sha256).delete()
+            session.add(TelegramFile(path=path, sha256=sha256, file_id=file_id,
+                                     upload_time=datetime.utcnow()))
+
+    def delete_telegram_file_id(self, path, sha256):
+        with self.session_scope() as session:
+            session.query(TelegramFile).filter_by(path=path, sha256=sha256).delete()
 
     def nurse_queue_pending(self):
-        return bool(self.session.query(Escalation.pending).filter_by(pending=True).first())
+        with self.session_scope() as session:
+            return bool(session.query(Escalation.pending).filter_by(pending=True).first())
 
     def get_nurse_queue_first_pending(self):
-        return self.session.query(Escalation).filter_by(pending=True).order_by(Escalation.escalated_time.asc()).first()
+        with self.session_scope() as session:
+            return session.query(Escalation).filter_by(pending=True).order_by(Escalation.escalated_time.asc()).first()
 
     def nurse_queue_mark_answered(self, chat_id):
-        self.session.query(Escalation).filter_by(
-            chat_src_id=chat_id, pending=True).update({'pending': False, 'replied_time': datetime.utcnow()})
-        self.commit()
+        with self.session_scope() as session:
+            session.query(Escalation).filter_by(
+                chat_src_id=chat_id, pending=True).update({'pending': False, 'replied_time': datetime.utcnow()})
+
+
+# (version, description, step). Add a step here whenever the models change.
+# Databases from before the schema_version table start at version 0; both
+# steps are safe to run against them.
+MIGRATIONS = [
+    (1, 'create tables', lambda db: Base.metadata.create_all(db.engine)),
+    (2, 'add indexes for the hot queries', lambda db: db.create_missing_indexes()),
+    (3, 'add telegram_files', lambda db: Base.metadata.create_all(db.engine)),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _engine_options(connection):
+    url = make_url(connection)
+    if url.get_backend_name() == 'sqlite':
+        # SQLite connections are cheap to open and can't be shared between
+        # threads, so SQLAlchemy doesn't pool them
+        return {}
+    options = {
+        'pool_size': settings.DB_POOL_SIZE,
+        'max_overflow': settings.DB_POOL_MAX_OVERFLOW,
+        'pool_timeout': settings.DB_POOL_TIMEOUT_SECONDS,
+        'pool_recycle': settings.DB_POOL_RECYCLE_SECONDS,
+        'pool_pre_ping': True,
+    }
+    if url.get_driver_name() == 'psycopg2':
+        # Send executemany() as a few large batches instead of a round trip
+        # per row
+        options['use_batch_mode'] = True
+    return options
+
+
+def _insert_ignoring_duplicates(table, session):
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
+
+
+def _copy_value(value):
+    # COPY's text format
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _record_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # In case a connection from before a fork gets here anyway: never use
+    # it (or close it) in the child, make the pool open a new one.
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise DisconnectionError(
+            f'Connection belongs to process {connection_record.info["pid"]}')
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in settings.DB_SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+class MessageLog(metaclass=Singleton):
+    """Write-behind buffer for Message rows. A background thread writes
+    them in one transaction once MESSAGE_LOG_BATCH_SIZE are waiting or
+    MESSAGE_LOG_FLUSH_SECONDS have passed, instead of committing every
+    message on its own. If the database is down, up to
+    MESSAGE_LOG_MAX_PENDING messages are kept for the next try."""
+
+    def __init__(self):
+        self.pending = []
+        self.condition = threading.Condition()
+        # Held while a batch is being written, so a flush at shutdown waits
+        # for the background thread's write instead of finding nothing to do
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def add(self, msg):
+        if not settings.MESSAGE_LOG_BATCH_SIZE:
+            # Synchronous mode, e.g. for tests
+            Database().insert(msg)
+            return
+        with self.condition:
+            self.pending.append(msg)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            if len(self.pending) >= settings.MESSAGE_LOG_BATCH_SIZE:
+                self.condition.notify()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.condition:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return 0
+            # On a connection of our own, so flushing never joins (or commits)
+            # the caller's unit of work
+            try:
+                Database().insert_messages(batch)
+            except:
+                logger.exception(f'Unable to write {len(batch)} messages, will retry')
+                with self.condition:
+                    self.pending[:0] = batch
+                    dropped = len(self.pending) - settings.MESSAGE_LOG_MAX_PENDING
+                    if dropped > 0:
+                        # Oldest first
+                        del self.pending[:dropped]
+                        logger.error(f'Message log is full, dropped {dropped} messages')
+                return 0
+            return len(batch)
+
+    def after_fork(self):
+        # The parent still has (and will write) its own pending messages
+        self.pending = []
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if len(self.pending) < settings.MESSAGE_LOG_BATCH_SIZE:
+                    self.condition.wait(settings.MESSAGE_LOG_FLUSH_SECONDS)
+            self.flush()
+
+
+def after_fork():
+    """Make the Database and MessageLog (if this process has them) safe to
+    use in a forked child process."""
+    for cls in (Database, MessageLog):
+        instance = Singleton._instances.get(cls)
+        if instance is not None:
+            instance.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    # Python 3.7+. uwsgi forks from C, so app.py also uses uwsgi's postfork.
+    os.register_at_fork(after_in_child=after_fork)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Database maintenance')
+    parser.add_argument('command', choices=['migrate', 'archive'])
+    parser.add_argument('--days', type=int,
+                        help='archive messages older than this (default MESSAGE_ARCHIVE_AFTER_DAYS)')
+    # simple-settings reads its own --settings argument
+    args, _ = parser.parse_known_args()
+
+    if args.command == 'migrate':
+        print(f'The database schema is at version {Database().migrate()}')
+    elif args.command == 'archive':
+        print(f'Archived {Database().archive_messages(args.days)} messages')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+A small character n-gram intent classifier that only needs NumPy at
+runtime. It is a drop-in replacement for the Rasa pipeline in
+nlu_config.yml, which needs TensorFlow for a handful of intents.
+
+Train it with:
+
+    $ SIMPLE_SETTINGS=localsettings python ngram_nlu.py
+
+which reads data/nlu-training-data.md, nlu_data.NUMBERS and
+nlu_data.OUT_OF_SCOPE and writes the model to settings.NLU_NGRAM_MODEL.
+Unlike Rasa, it has an explicit label for free text that isn't any of the
+intents, since otherwise it has to pick one of them.
+"""
+import os
+import zlib
+
+import numpy as np
+from simple_settings import settings
+
+from nlu_data import OUT_OF_SCOPE, OUT_OF_SCOPE_LABEL, load_training_examples
+
+
+def _normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def _ngrams(text, min_n, max_n):
+    # Pad with spaces so the start and end of words get their own n-grams
+    text = f' {_normalize(text)} '
+    for n in range(min_n, max_n + 1):
+        for i in range(len(text) - n + 1):
+            yield text[i:i + n]
+
+
+class CharNgramClassifier(object):
+    """Softmax regression over hashed character n-gram counts."""
+
+    def __init__(self, labels, weights, bias, min_n=1, max_n=3):
+        self.labels = list(labels)
+        self.weights = weights
+        self.bias = bias
+        self.min_n = min_n
+        self.max_n = max_n
+
+    @property
+    def dim(self):
+        return self.weights.shape[0]
+
+    def featurize(self, texts):
+        x = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for gram in _ngrams(text, self.min_n, self.max_n):
+                # crc32 rather than hash() so features are stable across
+                # processes
+                x[row, zlib.crc32(gram.encode('utf-8')) % self.dim] += 1
+        norms = np.linalg.norm(x, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return x / norms
+
+    def predict_proba(self, texts):
+        scores = self.featurize(texts) @ self.weights + self.bias
+        scores -= scores.max(axis=1, keepdims=True)
+        probs = np.exp(scores)
+        return probs / probs.sum(axis=1, keepdims=True)
+
+    def predict_batch(self, texts, min_margin=0):
+        """Return a (label, confidence) pair for each text. The label is
+        None when the runner-up is within min_margin of it."""
+        if not texts:
+            return []
+        probs = self.predict_proba(texts)
+        best = probs.argmax(axis=1)
+        top2 = np.sort(probs, axis=1)[:, -2:] if probs.shape[1] > 1 else None
+        results = []
+        for row, i in enumerate(best):
+            label = self.labels[i]
+            if top2 is not None and top2[row, 1] - top2[row, 0] < min_margin:
+                label = None
+            results.append((label, float(probs[row, i])))
+        return results
+
+    def predict(self, text):
+        return self.predict_batch([text])[0]
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        np.savez_compressed(filename,
+                            labels=np.array(self.labels),
+                            weights=self.weights.astype(np.float16),
+                            bias=self.bias.astype(np.float32),
+                            ngram_range=np.array([self.min_n, self.max_n]))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            min_n, max_n = data['ngram_range']
+            return cls(data['labels'].tolist(),
+                       data['weights'].astype(np.float32),
+                       data['bias'],
+                       int(min_n), int(max_n))
+
+
+#################################################
+# Training
+#################################################
+def train(examples, dim=4096, min_n=1, max_n=3, epochs=500,
+          learning_rate=10.0, l2=1e-5):
+    labels = sorted({label for _, label in examples})
+    label_idx = {label: i for i, label in enumerate(labels)}
+    model = CharNgramClassifier(
+        labels,
+        np.zeros((dim, len(labels)), dtype=np.float32),
+        np.zeros(len(labels), dtype=np.float32),
+        min_n, max_n)
+
+    x = model.featurize([text for text, _ in examples])
+    y = np.zeros((len(examples), len(labels)), dtype=np.float32)
+    y[np.arange(len(examples)), [label_idx[l] for _, l in examples]] = 1
+
+    # Plain full-batch gradient descent; the data set is tiny
+    for _ in range(epochs):
+        scores = x @ model.weights + model.bias
+        scores -= scores.max(axis=1, keepdims=True)
+        probs = np.exp(scores)
+        probs /= probs.sum(axis=1, keepdims=True)
+        grad = (probs - y) / len(examples)
+        model.weights -= learning_rate * (x.T @ grad + l2 * model.weights)
+        model.bias -= learning_rate * grad.sum(axis=0)
+    return model
+
+
+def main():
+    examples = load_training_examples()
+    examples += [(text, OUT_OF_SCOPE_LABEL) for text in OUT_OF_SCOPE]
+    model = train(examples)
+    predicted = model.predict_batch([text for text, _ in examples])
+    correct = sum(p == label for (p, _), (_, label) in zip(predicted, examples))
+    model.save(settings.NLU_NGRAM_MODEL)
+    print(f'Trained on {len(examples)} examples, {len(model.labels)} labels; '
+          f'training accuracy {correct / len(examples):.3f}. '
+          f'Saved to {settings.NLU_NGRAM_MODEL}')
+
+
+if __name__ == '__main__':
+    main()
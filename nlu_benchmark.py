@@ -0,0 +1,155 @@
+"""
+Accuracy and latency benchmark for the intent classifiers.
+
+Replays the labelled examples from data/nlu-training-data.md (and
+nlu_data.NUMBERS) through each classifier and reports per-intent
+precision/recall, p50/p99 latency, throughput and memory as JSON, so runs
+for different classifier versions can be diffed. Optionally also replays
+the most recent user messages from the messages table (unlabelled, so only
+latency and the intent mix are reported for those).
+
+    $ SIMPLE_SETTINGS=localsettings python nlu_benchmark.py --classifiers dict ngram --messages 5000 --output bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+
+import customnlu
+from customnlu import Intent
+from nlu_data import load_training_examples
+
+CLASSIFIERS = {
+    # Exact/fuzzy dictionary lookup used on the hot path
+    'dict': customnlu.get_intent,
+    # The Rasa model itself, in this process, whatever NLU_CLASSIFIER and
+    # NLU_SERVICE_WORKERS say
+    'rasa': lambda msg: customnlu._rasa_result_to_intent(
+        customnlu.get_interpreter().parse(msg)),
+    'ngram': lambda msg: customnlu.get_ngram_intents([msg])[0],
+}
+
+
+def _max_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def _run(classify, texts):
+    intents, latencies = [], []
+    start = time.perf_counter()
+    for text in texts:
+        t = time.perf_counter()
+        intents.append(classify(text))
+        latencies.append((time.perf_counter() - t) * 1000)
+    elapsed = time.perf_counter() - start
+    return intents, {
+        'count': len(texts),
+        'p50_ms': _percentile(latencies, 50),
+        'p99_ms': _percentile(latencies, 99),
+        'max_ms': max(latencies) if latencies else None,
+        'throughput_per_s': len(texts) / elapsed if elapsed else None,
+    }
+
+
+def _scores(expected, predicted):
+    per_intent = {}
+    for intent in sorted(set(expected) | set(predicted)):
+        tp = sum(e == p == intent for e, p in zip(expected, predicted))
+        n_predicted = sum(p == intent for p in predicted)
+        n_expected = sum(e == intent for e in expected)
+        per_intent[intent.name] = {
+            'precision': tp / n_predicted if n_predicted else None,
+            'recall': tp / n_expected if n_expected else None,
+            'support': n_expected,
+        }
+    correct = sum(e == p for e, p in zip(expected, predicted))
+    return correct / len(expected), per_intent
+
+
+def _historical_messages(limit):
+    from db import Database, Message
+    rows = Database().session.query(Message.msg).filter(
+        Message.source == 'user').order_by(Message.id.desc()).limit(limit)
+    return [row.msg for row in rows if row.msg]
+
+
+def _benchmark_classifier(name, texts, expected, history):
+    classify = CLASSIFIERS[name]
+    rss_before = _max_rss_mb()
+    # The first call pays for loading the model
+    t = time.perf_counter()
+    classify('hello')
+    load_seconds = time.perf_counter() - t
+
+    predicted, latency = _run(classify, texts)
+    accuracy, per_intent = _scores(expected, predicted)
+    result = {
+        'load_seconds': load_seconds,
+        'accuracy': accuracy,
+        'per_intent': per_intent,
+        'latency': latency,
+    }
+    if history:
+        intents, history_latency = _run(classify, history)
+        result['history'] = {
+            'latency': history_latency,
+            'intents': {i.name: intents.count(i) for i in set(intents)},
+            'unknown_rate': intents.count(Intent.UNKNOWN) / len(intents),
+        }
+    result['max_rss_mb'] = _max_rss_mb()
+    result['max_rss_growth_mb'] = result['max_rss_mb'] - rss_before
+    return result
+
+
+def benchmark(classifier_names, message_limit=0):
+    examples = load_training_examples()
+    texts = [text for text, _ in examples]
+    expected = [customnlu._label_to_intent(label) for _, label in examples]
+    history = _historical_messages(message_limit) if message_limit else []
+
+    # ru_maxrss only ever goes up, so each classifier gets a fresh process
+    # of its own; otherwise its memory would depend on what ran before it
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for name in classifier_names:
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(
+                _benchmark_classifier, (name, texts, expected, history))
+
+    return {
+        'examples': len(examples),
+        'history_messages': len(history),
+        'classifiers': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--classifiers', nargs='+', choices=sorted(CLASSIFIERS),
+                        default=['dict'])
+    parser.add_argument('--messages', type=int, default=0,
+                        help='also replay this many recent user messages from the DB')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    # simple-settings reads its own --settings argument
+    args, _ = parser.parse_known_args()
+
+    report = benchmark(args.classifiers, args.messages)
+    out = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,11 @@
+import re
+
+TRAINING_DATA = 'data/nlu-training-data.md'
+
+# [text](entity:value), plus the odd "[text] more(entity:value)" in our data
+ENTITY_RE = re.compile(r'\(\w+:(\w+)\)')
+MARKUP_RE = re.compile(r'[\[\]]|\(\w+:\w+\)')
+
 NUMBERS = {
     'one': 'one',
     '1': 'one',
@@ -290,3 +298,94 @@ NUMBERS = {
     'बिलकुल नहीं': 'no',
     'नहीं चाइये': 'no',
 }
+
+# Free text that isn't any of the intents: questions for the nurse, news
+# about the baby (thanks and goodbyes are "restart" in the training data).
+# The n-gram classifier learns to label these OUT_OF_SCOPE_LABEL, so such
+# messages go to the nurse instead of to whichever intent is closest.
+OUT_OF_SCOPE_LABEL = 'out_of_scope'
+OUT_OF_SCOPE = [
+    'how much water should i give',
+    'how many times a day should she eat',
+    'how much food is enough for my child',
+    'what should i feed my baby',
+    'what can i give for breakfast',
+    'when can i start giving dal',
+    'can i give cow milk',
+    'is banana good for babies',
+    'my child does not eat vegetables',
+    'my son is not eating anything',
+    'baby is vomiting',
+    'my daughter has a cold',
+    'she has loose motions',
+    'he has diarrhoea since yesterday',
+    'the baby is crying a lot',
+    'my baby is sick',
+    'child has a cough',
+    'my baby weight is low',
+    'how do i know if he is growing well',
+    'where is the anganwadi centre',
+    'when is the next vaccination',
+    'who is this',
+    'what is your name',
+    'i did not understand',
+    'i will send the photo later',
+    'my phone was switched off',
+    'i was busy today',
+    'bacche ko khana nahi pachta',
+    'baccha doodh nahi pee raha',
+    'mera beta khana nahi khata',
+    'bachi ko dast ho rahe hain',
+    'bacche ko khansi hai',
+    'kitna paani dena chahiye',
+    'din mein kitni baar khilana hai',
+    'kya main gaay ka doodh de sakti hoon',
+    'anganwadi kab khulegi',
+    'tika kab lagega',
+    'aap kaun ho',
+    'mujhe samajh nahi aaya',
+    'बच्चा खाना नहीं खा रहा है',
+    'बच्चे को दस्त हो रहे हैं',
+    'मेरी बेटी को सर्दी है',
+    'बच्चा बहुत रो रहा है',
+    'बच्चे को उल्टी हो रही है',
+    'कितना दूध देना चाहिए',
+    'दिन में कितनी बार खिलाना है',
+    'क्या मैं केला दे सकती हूँ',
+    'टीका कब लगेगा',
+    'आंगनवाड़ी केंद्र कहाँ है',
+    'आप कौन हैं',
+    'मुझे समझ नहीं आया',
+    'मेरा बच्चा बीमार है',
+    'बच्चे का वजन कम है',
+]
+
+
+# Labelled examples for training and benchmarking classifiers
+def load_training_examples(filename=TRAINING_DATA):
+    """(text, label) pairs from the Rasa markdown training data and from
+    NUMBERS. Options are labelled with their number entity
+    ("one".."ten") rather than "option", and synonyms with their value,
+    so numbers come out of the classifier directly."""
+    examples = []
+    label = None
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('## '):
+                kind, _, name = line[3:].partition(':')
+                label = name if kind in ('intent', 'synonym') else None
+            elif line.startswith('- ') and label:
+                text = line[2:]
+                example_label = label
+                if label == 'option':
+                    entity = ENTITY_RE.search(text)
+                    if entity is None:
+                        continue
+                    example_label = entity.group(1)
+                text = MARKUP_RE.sub('', text).strip()
+                if text:
+                    examples.append((text, example_label))
+
+    examples.extend(NUMBERS.items())
+    return examples
@@ -0,0 +1,126 @@
+"""
+Runs the NLU model in a pool of worker processes. Callers in the bot hand
+messages to a local queue; a batching thread groups whatever arrives within
+NLU_SERVICE_BATCH_WAIT_MS into one request to the pool. If a result takes
+longer than NLU_SERVICE_TIMEOUT_SECONDS the caller gets Intent.UNKNOWN
+instead, so a slow model never stalls message handling.
+
+Turned on by setting NLU_SERVICE_WORKERS; customnlu.get_rasa_intent then
+goes through here.
+"""
+from functools import partial
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+from simple_settings import settings
+
+import customnlu
+from customnlu import Intent
+
+logger = logging.getLogger(__name__)
+
+
+#################################################
+# Worker processes
+#################################################
+def _init_worker():
+    # Load the model up front rather than on the first batch
+    if settings.NLU_CLASSIFIER == 'ngram':
+        customnlu.get_ngram_classifier()
+    else:
+        customnlu.get_interpreter()
+
+
+def _classify_batch(msgs):
+    return [int(intent) for intent in customnlu.classify_batch(msgs)]
+
+
+#################################################
+# Client
+#################################################
+class _Request(object):
+    def __init__(self, msg, timeout):
+        self.msg = msg
+        self.deadline = time.monotonic() + timeout
+        self.intent = Intent.UNKNOWN
+        self.done = threading.Event()
+
+
+class NluClient(object):
+    def __init__(self, workers, batch_size, batch_wait_seconds, timeout_seconds):
+        self.batch_size = batch_size
+        self.batch_wait_seconds = batch_wait_seconds
+        self.timeout_seconds = timeout_seconds
+        # spawn rather than fork: the bot has threads (and maybe TensorFlow)
+        # running by the time the pool starts
+        self.pool = multiprocessing.get_context('spawn').Pool(
+            workers, initializer=_init_worker)
+        self.requests = queue.Queue()
+        self.batcher = threading.Thread(target=self._batch_loop, daemon=True)
+        self.batcher.start()
+
+    def classify(self, msg):
+        request = _Request(msg, self.timeout_seconds)
+        self.requests.put(request)
+        if not request.done.wait(self.timeout_seconds):
+            logger.warning(
+                f'NLU timed out after {self.timeout_seconds}s, treating "{msg}" as unknown')
+        return request.intent
+
+    def close(self):
+        self.pool.terminate()
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        batch_deadline = time.monotonic() + self.batch_wait_seconds
+        while len(batch) < self.batch_size:
+            remaining = batch_deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Nobody is waiting for requests that already timed out
+        now = time.monotonic()
+        return [r for r in batch if r.deadline > now]
+
+    def _batch_loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            self.pool.apply_async(
+                _classify_batch, ([r.msg for r in batch],),
+                callback=partial(self._resolve, batch),
+                error_callback=partial(self._fail, batch))
+
+    def _resolve(self, batch, intents):
+        for request, intent in zip(batch, intents):
+            request.intent = Intent(intent)
+            request.done.set()
+
+    def _fail(self, batch, error):
+        logger.error(f'NLU worker failed on a batch of {len(batch)}: {error}')
+        for request in batch:
+            request.done.set()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = NluClient(
+                    settings.NLU_SERVICE_WORKERS,
+                    settings.NLU_SERVICE_BATCH_SIZE,
+                    settings.NLU_SERVICE_BATCH_WAIT_MS / 1000,
+                    settings.NLU_SERVICE_TIMEOUT_SECONDS)
+    return _client
@@ -4,8 +4,10 @@ import re
 
 # from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 from simple_settings import settings
+from sqlalchemy import case
 
 import beneficiary_bot
+import outbox
 from db import Database, User, Message, Escalation
 from send import send_text_reply, send_image_reply, _log_msg
 
@@ -55,13 +57,13 @@ def _send_next_module_and_log(update, context, user):
 
     # Send the content
     for msg_txt in msgs:
+        msg_txt = beneficiary_bot.replace_template(msg_txt, context)
         # Log the message from system-new-module to the user
-        _log_msg(beneficiary_bot.replace_template(msg_txt, context), 'system-new-module', update,
+        _log_msg(msg_txt, 'system-new-module', update,
                  state=Database().get_state_name_from_chat_id(user.chat_id),
                  chat_id=str(user.chat_id))
         # And send it
-        context.bot.send_message(
-            user.chat_id, beneficiary_bot.replace_template(msg_txt, context))
+        outbox.send_message(context.bot, user.chat_id, msg_txt)
 
     for img in imgs:
         # Log the image from system-new-module to the user
@@ -69,44 +71,58 @@ def _send_next_module_and_log(update, context, user):
                  state=Database().get_state_name_from_chat_id(user.chat_id),
                  chat_id=str(user.chat_id))
         # And send it
-        f = open(beneficiary_bot.prepend_img_path(img), 'rb')
-        context.bot.send_photo(
-            user.chat_id, f)
-        f.close()
+        outbox.send_photo(context.bot, user.chat_id,
+                          beneficiary_bot.prepend_img_path(img))
 
     user.current_state = next_state_id
     user.current_state_name = next_state_name
     return user
 
 
+def _set_states(session, states):
+    """states maps (state_id, state_name) to the ids of the users to set
+    it for. Returns the number of users updated."""
+    count = 0
+    for (state_id, state_name), user_ids in states.items():
+        count += session.query(User).filter(User.id.in_(user_ids)).update(
+            {User.current_state: state_id, User.current_state_name: state_name},
+            synchronize_session=False)
+    return count
+
+
 def send_next_module(update, context, cohort):
     # Find all the users whose:
     # - next_module is less than max
     # - not a test user
     # - Registration was before cutoff
-    users = Database().session.query(User).filter(
-        (User.test_user == False) &
-        (User.cohort == cohort) &
-        (((User.track == '6') & (User.next_module <= settings.MAX_MODULE_6)) |
-            ((User.track == '12') & (User.next_module <= settings.MAX_MODULE_12)))
-    )
-
-    for user in users:
-        # Send out messages to user
-        beneficiary_bot.fetch_user_data(user.chat_id, context)
-        user = _send_next_module_and_log(update, context, user)
-
-        # Increment next_module
-        user.next_module = user.next_module + 1
-
-        # Set 'started' and 'first_msg_date' if needed
-        if not user.started:
-            user.started = True
-            user.first_msg_date = datetime.utcnow()
-
-    # Save back to DB
-    Database().commit()
-    return users.count()
+    user_count = 0
+    for users in Database().iter_user_chunks(
+            (User.test_user == False) &
+            (User.cohort == cohort) &
+            (((User.track == '6') & (User.next_module <= settings.MAX_MODULE_6)) |
+                ((User.track == '12') & (User.next_module <= settings.MAX_MODULE_12)))):
+        states = {}
+        for user in users:
+            # Send out messages to user
+            beneficiary_bot.fetch_user_data(user.chat_id, context)
+            user = _send_next_module_and_log(update, context, user)
+            states.setdefault(
+                (user.current_state, user.current_state_name), []).append(user.id)
+
+        # Save the chunk back to the DB: increment next_module, set
+        # 'started' and 'first_msg_date' if needed, and the new states
+        with Database().session_scope() as session:
+            user_count += session.query(User).filter(
+                User.id.in_([user.id for user in users])
+            ).update({
+                User.first_msg_date: case([(User.started == False, datetime.utcnow())],
+                                          else_=User.first_msg_date),
+                User.started: True,
+                User.next_module: User.next_module + 1,
+            }, synchronize_session=False)
+            _set_states(session, states)
+        Database().invalidate_users(user.chat_id for user in users)
+    return user_count
 
 
 def send_next_modules(update, context):
@@ -132,39 +148,51 @@ def send_next_modules(update, context):
         f'Successfully changed the state for {user_count} users!', update)
 
 
+def reload_content(update, context):
+    logger.warning('Reload content called in GOD mode!')
+    _log_msg(update.message.text, 'GOD', update)
+
+    if beneficiary_bot.reload_state_machines():
+        return send_text_reply(
+            'Ok. Successfully reloaded the flows and translations.', update)
+    return send_text_reply(
+        'Unable to reload the flows and translations, still using the old ones. Check the logs for details.', update)
+
+
 #################################################
 # Nurse queue
 #################################################
 def _check_nurse_queue(context, escalation=None):
-    first_pending = Database().get_nurse_queue_first_pending()
-    try:
-        relevant_messages = Database().session.query(
-            Escalation
-        ).filter_by(pending=True, chat_src_id=first_pending.chat_src_id)
-    except AttributeError:
-        # No pending messages
-        return
-
-    # If escalation exists, then only send if the escalation is relevant
-    if escalation and first_pending.chat_src_id != escalation.chat_src_id:
-        return
-
-    for msg in relevant_messages:
-        _log_msg(msg.msg_txt, 'system-unsent', None, msg.state_name_when_escalated,
-                 chat_id=settings.NURSE_CHAT_ID)
-        #  TODO: does the line below make any sense??
-        msg.replied_time = datetime.utcnow()
+    with Database().session_scope() as session:
+        first_pending = Database().get_nurse_queue_first_pending()
+        try:
+            relevant_messages = session.query(
+                Escalation
+            ).filter_by(pending=True, chat_src_id=first_pending.chat_src_id).all()
+        except AttributeError:
+            # No pending messages
+            return
+
+        # If escalation exists, then only send if the escalation is relevant
+        if escalation and first_pending.chat_src_id != escalation.chat_src_id:
+            return
+
+        for msg in relevant_messages:
+            _log_msg(msg.msg_txt, 'system-unsent', None, msg.state_name_when_escalated,
+                     chat_id=settings.NURSE_CHAT_ID)
+            #  TODO: does the line below make any sense??
+            msg.replied_time = datetime.utcnow()
 
     nl = '\n'
     msg = (f"The following message(s) are from "
            f"'{first_pending.first_name}' ({first_pending.chat_src_id}). "
            f"Your reply will be forwarded automatically.\n\n"
            f"{nl.join([m.msg_txt for m in relevant_messages])}")
-    context.bot.send_message(
+    outbox.send_message(
+        context.bot,
         settings.NURSE_CHAT_ID,
         msg
     )
-    # Database().commit()
 
 
 def skip(update,context):
@@ -194,13 +222,13 @@ def _send_message_to_queue(update, context, msgs_txt, imgs=[]):
     beneficiary_bot.fetch_user_data(escalation.chat_src_id, context)
 
     for msg_txt in msgs_txt:
+        msg_txt = beneficiary_bot.replace_template(msg_txt, context)
         # Log the message from nurse to the user
-        _log_msg(beneficiary_bot.replace_template(msg_txt, context), 'nurse', update,
+        _log_msg(msg_txt, 'nurse', update,
                  state=Database().get_state_name_from_chat_id(escalation.chat_src_id),
                  chat_id=str(escalation.chat_src_id))
         # And send it
-        context.bot.send_message(
-            escalation.chat_src_id, beneficiary_bot.replace_template(msg_txt, context))
+        outbox.send_message(context.bot, escalation.chat_src_id, msg_txt)
 
     for img in imgs:
         # Log the image from nurse to the user
@@ -208,23 +236,21 @@ def _send_message_to_queue(update, context, msgs_txt, imgs=[]):
                  state=Database().get_state_name_from_chat_id(escalation.chat_src_id),
                  chat_id=str(escalation.chat_src_id))
         # And send it
-        f = open(beneficiary_bot.prepend_img_path(img), 'rb')
-        context.bot.send_photo(
-            escalation.chat_src_id, f)
-        f.close()
+        outbox.send_photo(context.bot, escalation.chat_src_id,
+                          beneficiary_bot.prepend_img_path(img))
 
 def _send_message_to_chat_id(update, context, chat_id, msgs_txt):
     """Send msg_text to a specific chat_id from GOD mode."""
     beneficiary_bot.fetch_user_data(chat_id, context)
 
     for msg_txt in msgs_txt:
+        msg_txt = beneficiary_bot.replace_template(msg_txt, context)
         # Log the message from nurse to the user
-        _log_msg(beneficiary_bot.replace_template(msg_txt, context), 'GOD', update,
+        _log_msg(msg_txt, 'GOD', update,
                  state=Database().get_state_name_from_chat_id(chat_id),
                  chat_id=str(chat_id))
         # And send it
-        context.bot.send_message(
-            chat_id, beneficiary_bot.replace_template(msg_txt, context))
+        outbox.send_message(context.bot, chat_id, msg_txt)
 
 
 def _send_images_to_chat_id(update, context, chat_id, imgs):
@@ -237,10 +263,8 @@ def _send_images_to_chat_id(update, context, chat_id, imgs):
                  state=Database().get_state_name_from_chat_id(chat_id),
                  chat_id=str(chat_id))
         # And send it
-        f = open(beneficiary_bot.prepend_img_path(img), 'rb')
-        context.bot.send_photo(
-            chat_id, f)
-        f.close()
+        outbox.send_photo(context.bot, chat_id,
+                          beneficiary_bot.prepend_img_path(img))
 
 
 #################################################
@@ -248,7 +272,7 @@ def _send_images_to_chat_id(update, context, chat_id, imgs):
 #################################################
 def _set_user_state(update, chat_id, new_state):
     # Set the state for the user manually
-    our_user = Database().session.query(User).filter_by(chat_id=str(chat_id)).first()
+    our_user = Database().get_user(chat_id)
     sm = beneficiary_bot.get_sm_from_track(our_user.track)
     try:
         state_id = sm.get_state_id_from_state_name(new_state)
@@ -256,9 +280,7 @@ def _set_user_state(update, chat_id, new_state):
         send_text_reply(
             f"Usage details: /state <new_state_name>\n '{new_state}' not recognized as a valid state.", update)
         return False
-    our_user.current_state = state_id
-    our_user.current_state_name = new_state
-    Database().commit()
+    Database().set_user_state(chat_id, state_id, new_state)
     return True
 
 
@@ -296,7 +318,7 @@ def set_state(update, context):
         # failed to find the state the nurse requested
         return
 
-    our_user = Database().session.query(User).filter_by(chat_id=str(chat_id)).first()
+    our_user = Database().get_user(chat_id)
     sm = beneficiary_bot.get_sm_from_track(our_user.track)
     msgs, imgs, _, _, _ = sm.get_msg_and_next_state(
         new_state, our_user.child_gender)
@@ -337,7 +359,7 @@ def set_super_state(update, context):
         # failed to find the state the nurse requested
         return
 
-    our_user = Database().session.query(User).filter_by(chat_id=str(chat_id)).first()
+    our_user = Database().get_user(chat_id)
     sm = beneficiary_bot.get_sm_from_track(our_user.track)
     msgs, imgs, _, _, _ = sm.get_msg_and_next_state(
         new_state, our_user.child_gender)
@@ -375,39 +397,48 @@ def set_cohort_super_state(update, context):
     # Find all the users whose:
     # - not a test user
     # - in the correct cohort
-    users = Database().session.query(User).filter(
-        ((User.test_user == False) &
-        (User.cohort == cohort))
-    )
-
-    for user in users:
-        # set the state for the user!
-        sm = beneficiary_bot.get_sm_from_track(user.track)
+    in_cohort = (User.test_user == False) & (User.cohort == cohort)
+
+    # Check the state exists on every track in the cohort before changing
+    # anyone, so we never stop with only some of the users moved
+    with Database().session_scope() as session:
+        tracks = [track for track, in session.query(User.track).filter(in_cohort).distinct()]
+    state_ids = {}
+    for track in tracks:
+        sm = beneficiary_bot.get_sm_from_track(track)
         try:
-            state_id = sm.get_state_id_from_state_name(new_state)
+            state_ids[track] = sm.get_state_id_from_state_name(new_state)
         except ValueError:
             send_text_reply(
                 f"for GOD mode: /cohortstate <cohort_number> <new_state_name>\n'{new_state}' not recognized as a valid state.", update)
             return False
-        user.current_state = state_id
-        user.current_state_name = new_state
 
-        msgs, imgs, _, _, _ = sm.get_msg_and_next_state(
-            new_state, user.child_gender)
-        beneficiary_bot.fetch_user_data(user.chat_id, context)
-        msgs, imgs = beneficiary_bot.replace_custom_message(msgs, imgs, context)
-        _send_message_to_chat_id(
-            update, context, user.chat_id,
-            msgs)
-        _send_images_to_chat_id(
-            update, context, user.chat_id,
-            imgs)
-
-    # Save back to DB
-    Database().commit()
+    user_count = 0
+    for users in Database().iter_user_chunks(in_cohort):
+        # set the state for the users!
+        states = {}
+        for user in users:
+            states.setdefault((state_ids[user.track], new_state), []).append(user.id)
+        with Database().session_scope() as session:
+            user_count += _set_states(session, states)
+        Database().invalidate_users(user.chat_id for user in users)
+
+        for user in users:
+            sm = beneficiary_bot.get_sm_from_track(user.track)
+            msgs, imgs, _, _, _ = sm.get_msg_and_next_state(
+                new_state, user.child_gender)
+            beneficiary_bot.fetch_user_data(user.chat_id, context)
+            msgs, imgs = beneficiary_bot.replace_custom_message(msgs, imgs, context)
+            _send_message_to_chat_id(
+                update, context, user.chat_id,
+                msgs)
+            _send_images_to_chat_id(
+                update, context, user.chat_id,
+                imgs)
+
     # Tell the nurse and check the queue
     send_text_reply(
-        f"Ok. State successfully set to {new_state} and message sent to {users.count()} users in cohort {cohort}.", update)
+        f"Ok. State successfully set to {new_state} and message sent to {user_count} users in cohort {cohort}.", update)
 
 
 date_re = re.compile('[0-3]\d-[0-1]\d-[1-2]\d\d\d')
@@ -435,8 +466,9 @@ def send_vhnd_reminder(update, context):
             'Usage details for VHND: /vhnd <awc_id> <DD-MM-YYYY>', update)
         return
 
-    users = Database().session.query(User).filter_by(awc_code=awc_id)
-    logger.warning(f'Found {users.count()} users for AWC code {awc_id}')
+    with Database().session_scope() as session:
+        users = session.query(User).filter_by(awc_code=awc_id).all()
+    logger.warning(f'Found {len(users)} users for AWC code {awc_id}')
     for user in users:
         if settings.HINDI:
             msg = f'नमस्ते [mother name]! आपके क्षेत्र में टीकाकरण दिवस {date} को हो रहा है । अपने बच्चे [child name] के साथ अपने आंगनवाड़ी केंद्र जाना ना भूलें!'
@@ -447,9 +479,9 @@ def send_vhnd_reminder(update, context):
         _send_message_to_chat_id(
             update, context, user.chat_id, [msg]
         )
-    if users.count() > 0:
+    if len(users) > 0:
         send_text_reply(
-            f"Ok. Successfully sent VHND reminders to {users.count()} users.", update)
+            f"Ok. Successfully sent VHND reminders to {len(users)} users.", update)
     else:
         send_text_reply(
             f"Unable to find any users with AWC code {awc_id}", update)
@@ -458,24 +490,23 @@ def send_vhnd_reminder(update, context):
 def send_global_msg(update,context):
     # pre_sign_off="मेरे साथ इस गतिविधि में भाग लेने और बात करने के लिए धन्यवाद! पोशन दीदी के साथ बात-चीत करने का परीक्षण अक्टूबर 15, 2019 को समाप्त हो जाएगा जिसके बाद मैं उपलब्ध नहीं रहूंगी। यदि आपके पास मेरे लिए कोई और प्रश्न हैं, तो कृपया अंतिम तिथि से पहले मुझे संदेश भेजें।"
     sign_off="आप पोशन दीदी से बात करने वाले पहले कुछ उपयोगकर्ताओं में से एक हैं! अब हम इस परीक्षण अवधि के अंत तक पहुँच चुके हैं और इसलिए मुझे ऑफ़लाइन जाना होगा यानि की अब मैं उपलब्ध नहीं रहूंगी। मेरे साथ बात करके इस गतिविधि में भाग लेने के लिए धन्यवाद! यदि आपके बच्चे से सम्बंधित आपको पोषण या स्वास्थ्य पर अधिक प्रश्न हैं तो कृपया अपनी आंगनवाड़ी कार्यकर्ता [AWW name] से संपर्क करें।"
-    users = Database().session.query(User)
+    with Database().session_scope() as session:
+        users = session.query(User).all()
 
     n = 0
     for user in users:
         if user.chat_id.startswith('whatsapp') or user.cohort < 0 or user.cohort > 20:
             continue
-        logger.info(f'sending pre sign off to {user.chat_id}')
-        try:
-            _send_message_to_chat_id(
-                update,context,user.chat_id,[sign_off]
-            )
-            n = n + 1
-        except:
-            logger.warning(f'Error sending pre sign off to {user.chat_id}')
+        logger.info(f'queueing pre sign off to {user.chat_id}')
+        _send_message_to_chat_id(
+            update,context,user.chat_id,[sign_off]
+        )
+        n = n + 1
 
-    if users.count() > 0:
+    if len(users) > 0:
+        # Sent in the background by the outbox, which logs any failures
         send_text_reply(
-            f"Ok. Successfully sent pre sign off to {n} of {users.count()} users.", update)
+            f"Ok. Queued pre sign off for {n} of {len(users)} users.", update)
     else:
         send_text_reply(
             f"Unable to find any users to send pre sign off message", update)
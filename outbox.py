@@ -0,0 +1,319 @@
+"""
+Outbound message queue. Every message the bot sends goes through here so
+that we stay within Telegram's limits: about OUTBOX_GLOBAL_PER_SECOND
+messages a second overall and OUTBOX_PER_CHAT_PER_SECOND to any one chat
+(with short bursts of up to OUTBOX_PER_CHAT_BURST, so a menu still arrives
+at once). A pool of OUTBOX_WORKERS threads does the sending. Messages to
+the same chat are sent one at a time, in the order they were queued.
+
+Sends that fail with RetryAfter (flood control) or TimedOut are retried
+with backoff, up to OUTBOX_MAX_RETRIES times. Setting OUTBOX_WORKERS to 0
+sends everything inline instead, e.g. for tests.
+
+Images are only uploaded to Telegram once: after that they are sent by the
+file_id Telegram gave us (see FileIdCache).
+"""
+import atexit
+from collections import deque
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from simple_settings import settings
+from telegram import Bot, Message
+from telegram.error import BadRequest, RetryAfter, TimedOut
+
+from db import Database
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """rate tokens a second, up to burst at once. reserve() takes a token
+    straight away and says how long to wait before using it, so callers
+    are served in the order they asked."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds):
+        """Hand out nothing for the next seconds (e.g. after a RetryAfter)."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def full(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.burst
+
+
+class _Chat(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.jobs = deque()
+        # Waiting in Outbox.ready, or being sent by a worker
+        self.busy = False
+
+
+class Outbox(object):
+    def __init__(self, workers, global_rate, global_burst, chat_rate, chat_burst,
+                 max_retries):
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chats = {}
+        # (time the chat may send next, tiebreak, chat_id)
+        self.ready = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def send(self, chat_id, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs), which sends one message to chat_id."""
+        if not self.workers:
+            self._call(chat_id, fn, args, kwargs)
+            return
+        # The same chat can turn up as an int or a str
+        chat_id = str(chat_id)
+        with self.condition:
+            self._start_workers()
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = _Chat(
+                    TokenBucket(self.chat_rate, self.chat_burst))
+            chat.jobs.append((fn, args, kwargs))
+            if not chat.busy:
+                self._schedule(chat_id, chat)
+
+    def drain(self, timeout=None):
+        """Wait (up to timeout seconds) for everything queued to be sent."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while any(chat.busy for chat in self.chats.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def _start_workers(self):
+        # Threads don't survive a fork, so check rather than start them once
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _schedule(self, chat_id, chat):
+        chat.busy = True
+        send_at = time.monotonic() + chat.bucket.reserve()
+        heapq.heappush(self.ready, (send_at, next(self.counter), chat_id))
+        self.condition.notify_all()
+
+    def _next_job(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.ready and self.ready[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self.ready)
+                    chat = self.chats[chat_id]
+                    return chat_id, chat, chat.jobs.popleft()
+                self.condition.wait(self.ready[0][0] - now if self.ready else None)
+
+    def _work(self):
+        while True:
+            chat_id, chat, (fn, args, kwargs) = self._next_job()
+            time.sleep(self.global_bucket.reserve())
+            try:
+                self._call(chat_id, fn, args, kwargs)
+            except:
+                logger.exception(f'Unable to send a message to {chat_id}, dropping it')
+            with self.condition:
+                if chat.jobs:
+                    self._schedule(chat_id, chat)
+                else:
+                    chat.busy = False
+                    self._forget_idle_chats()
+                self.condition.notify_all()
+
+    def _forget_idle_chats(self):
+        # A chat's bucket only matters until it has filled up again
+        if len(self.chats) > 1000:
+            for chat_id in [chat_id for chat_id, chat in self.chats.items()
+                            if not chat.busy and chat.bucket.full()]:
+                del self.chats[chat_id]
+
+    def _call(self, chat_id, fn, args, kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                # Flood control applies to the whole bot, not just this chat
+                logger.warning(f'Flood control sending to {chat_id}, waiting {e.retry_after}s')
+                self.global_bucket.pause(e.retry_after)
+                time.sleep(e.retry_after)
+            except TimedOut:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f'Timed out sending to {chat_id}, retrying')
+                time.sleep(2 ** attempt)
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = Outbox(
+                    settings.OUTBOX_WORKERS,
+                    settings.OUTBOX_GLOBAL_PER_SECOND,
+                    settings.OUTBOX_GLOBAL_BURST,
+                    settings.OUTBOX_PER_CHAT_PER_SECOND,
+                    settings.OUTBOX_PER_CHAT_BURST,
+                    settings.OUTBOX_MAX_RETRIES)
+                atexit.register(_outbox.drain, settings.OUTBOX_DRAIN_SECONDS)
+    return _outbox
+
+
+#################################################
+# Uploaded files
+#################################################
+class FileIdCache(object):
+    """file_ids for images that have already been uploaded, stored in the
+    telegram_files table. Files are identified by path and content hash;
+    the hash is only recomputed when the file's mtime or size changes, so
+    a cached send doesn't read the file at all."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> ((mtime_ns, size), sha256)
+        self.hashes = {}
+        # (path, sha256) -> file_id, loaded on first use
+        self.file_ids = None
+        # (path, sha256) -> lock held while that file is being uploaded
+        self.uploading = {}
+
+    def key(self, filename):
+        path = os.path.normpath(filename)
+        stat = os.stat(path)
+        fingerprint = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.hashes.get(path)
+        if cached and cached[0] == fingerprint:
+            return path, cached[1]
+        with open(path, 'rb') as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        with self.lock:
+            self.hashes[path] = (fingerprint, sha256)
+        return path, sha256
+
+    def get(self, key):
+        with self.lock:
+            if self.file_ids is None:
+                self.file_ids = Database().get_telegram_file_ids()
+            return self.file_ids.get(key)
+
+    def put(self, key, file_id):
+        Database().save_telegram_file_id(*key, file_id)
+        with self.lock:
+            self.file_ids[key] = file_id
+
+    def forget(self, key):
+        Database().delete_telegram_file_id(*key)
+        with self.lock:
+            self.file_ids.pop(key, None)
+
+    def upload_lock(self, key):
+        with self.lock:
+            return self.uploading.setdefault(key, threading.Lock())
+
+    def send(self, send_fn, filename, args, kwargs):
+        key = self.key(filename)
+        file_id = self.get(key)
+        if file_id is not None:
+            try:
+                return send_fn(*args, file_id, **kwargs)
+            except BadRequest as e:
+                # Most BadRequests are about the chat, not the file
+                if not _is_file_id_error(e):
+                    raise
+                # Telegram no longer knows it
+                logger.warning(f'Cached file_id for {filename} rejected ({e}), uploading it again')
+                self.forget(key)
+
+        # Only upload each file once, even if several chats are waiting for it
+        with self.upload_lock(key):
+            file_id = self.get(key)
+            if file_id is not None:
+                return send_fn(*args, file_id, **kwargs)
+            with open(filename, 'rb') as f:
+                message = send_fn(*args, f, **kwargs)
+            self.put(key, message.photo[-1].file_id)
+            return message
+
+
+def _is_file_id_error(error):
+    # e.g. "Wrong file identifier/http url specified", "Wrong remote file id
+    # specified", "File_id_invalid"
+    message = str(error).lower()
+    return any(s in message for s in ('file identifier', 'file id', 'file_id'))
+
+
+_file_ids = FileIdCache()
+
+
+#################################################
+# Sending
+#################################################
+def _send_file(send_fn, filename, *args, **kwargs):
+    # Only real Telegram sends can use file_ids (not app.py's WhatsApp stand-in)
+    if settings.TELEGRAM_FILE_ID_CACHE and isinstance(
+            getattr(send_fn, '__self__', None), (Bot, Message)):
+        return _file_ids.send(send_fn, filename, args, kwargs)
+    # Opened when it is actually sent (and again for each retry)
+    with open(filename, 'rb') as f:
+        return send_fn(*args, f, **kwargs)
+
+
+def send_message(bot, chat_id, text, **kwargs):
+    get_outbox().send(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+
+def send_photo(bot, chat_id, filename, **kwargs):
+    get_outbox().send(chat_id, _send_file, bot.send_photo, filename, chat_id, **kwargs)
+
+
+def reply_text(update, text, **kwargs):
+    get_outbox().send(update.effective_chat.id, update.message.reply_text, text, **kwargs)
+
+
+def reply_photo(update, filename, **kwargs):
+    get_outbox().send(update.effective_chat.id, _send_file,
+                      update.message.reply_photo, filename, **kwargs)
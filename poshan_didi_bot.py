@@ -8,9 +8,12 @@ import logging
 import logging.handlers
 
 import beneficiary_bot
+import customnlu
 import nurse_bot
+import outbox
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 from simple_settings import settings
+from db import Database, MessageLog
 from registration import registration_conversation
 
 # Enable logging
@@ -35,13 +38,22 @@ def error(update, context):
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
 
+def archive_messages(context):
+    logger.info(f'Archived {Database().archive_messages()} old messages')
+
+
 def main():
     """Start the bot."""
+    Database().check_schema()
     beneficiary_bot.setup_state_machines()
+    if settings.NLU_PRELOAD_RASA:
+        customnlu.preload_interpreter()
 
     # Create the Updater and pass it the bot's token.
     # Make sure to set use_context=True to use the new context based callbacks
-    updater = Updater(settings.TELEGRAM_TOKEN, use_context=True)
+    # Leave enough HTTP connections for the outbox's send threads
+    updater = Updater(settings.TELEGRAM_TOKEN, use_context=True,
+                      request_kwargs={'con_pool_size': settings.OUTBOX_WORKERS + 8})
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
@@ -72,6 +84,10 @@ def main():
     # dp.add_handler(CommandHandler('vhnd', nurse_bot.send_vhnd_reminder,
     #                               Filters.chat(settings.GOD_MODE)))
     
+    # Reload flows and translations without a restart
+    dp.add_handler(CommandHandler('reload', nurse_bot.reload_content,
+                                  Filters.chat(settings.GOD_MODE)))
+
     # sign off messages
     dp.add_handler(CommandHandler('sendglobal', nurse_bot.send_global_msg,
                                   Filters.chat(settings.GOD_MODE)))
@@ -86,6 +102,16 @@ def main():
     # dp.add_handler(MessageHandler(
     #     (Filters.text & Filters.chat(settings.NURSE_CHAT_ID)), nurse_bot.process_nurse_input))
 
+    # Pick up edits to the flows and translations in the background
+    if settings.CONTENT_RELOAD_INTERVAL_SECONDS:
+        updater.job_queue.run_repeating(
+            beneficiary_bot.check_for_content_changes,
+            interval=settings.CONTENT_RELOAD_INTERVAL_SECONDS)
+
+    # Keep the messages table small
+    if settings.MESSAGE_ARCHIVE_AFTER_DAYS:
+        updater.job_queue.run_repeating(archive_messages, interval=24 * 60 * 60)
+
     # log all errors
     dp.add_error_handler(error)
     logger.info(
@@ -99,6 +125,10 @@ def main():
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    # Send and log anything still waiting
+    outbox.get_outbox().drain(settings.OUTBOX_DRAIN_SECONDS)
+    MessageLog().flush()
+
 
 if __name__ == '__main__':
     main()
@@ -4,7 +4,7 @@ from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, Rege
                           ConversationHandler)
 from db import User, Database
 from send import send_text_reply, _log_msg
-from customnlu import interpreter, get_intent, Intent
+from customnlu import get_intent, Intent
 from simple_settings import settings
 
 # Define the states
@@ -21,8 +21,7 @@ def cancel(update, context):
 
 def start(update, context):
     # Check for duplicate registration
-    user = Database().session.query(User).filter_by(
-        chat_id=str(update.effective_chat.id)).first()
+    user = Database().get_user(update.effective_chat.id)
     if user is not None:
         # User exists, so let 'em know
         msg_txt = 'You have already been registered! Please talk to your AWW [AWW name] on [AWW phone number] if you have any doubts.'
@@ -1,5 +1,6 @@
 from datetime import datetime
-from db import Database, Message
+from db import Database, Message, MessageLog
+import outbox
 
 
 def _log_msg(text, source, update, state=None, chat_id=None):
@@ -11,7 +12,7 @@ def _log_msg(text, source, update, state=None, chat_id=None):
         state=state,
         server_time=datetime.utcnow()
     )
-    Database().insert(msg)
+    MessageLog().add(msg)
 
 
 def send_image_reply(img, update, state=None, **kwargs):
@@ -20,9 +21,7 @@ def send_image_reply(img, update, state=None, **kwargs):
     _log_msg(img, 'system', update,
              state=state,
              chat_id=update.effective_chat.id)
-    f = open(img, 'rb')
-    update.message.reply_photo(f, **kwargs)
-    f.close()
+    outbox.reply_photo(update, img, **kwargs)
 
 
 def send_text_reply(txt, update, state=None, ** kwargs):
@@ -31,4 +30,4 @@ def send_text_reply(txt, update, state=None, ** kwargs):
     _log_msg(txt, 'system', update,
              state=state,
              chat_id=update.effective_chat.id)
-    update.message.reply_text(txt, **kwargs)
+    outbox.reply_text(update, txt, **kwargs)
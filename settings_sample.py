@@ -13,15 +13,100 @@ TELEGRAM_TOKEN = 'TOKEN_ID'
 # The telegram chatid with your bot for the escalation messages
 NURSE_CHAT_ID = 12345
 NURSE_CHAT_ID_WHATSAPP = 'whatsapp:+12345'
+# Outgoing messages are queued and sent by OUTBOX_WORKERS threads within
+# Telegram's rate limits (0 workers = send inline, e.g. for tests). Sends
+# that hit flood control or time out are retried OUTBOX_MAX_RETRIES times.
+OUTBOX_WORKERS = 4
+OUTBOX_GLOBAL_PER_SECOND = 25
+OUTBOX_GLOBAL_BURST = 5
+OUTBOX_PER_CHAT_PER_SECOND = 1
+OUTBOX_PER_CHAT_BURST = 5
+OUTBOX_MAX_RETRIES = 3
+# How long to keep sending what is queued when shutting down
+OUTBOX_DRAIN_SECONDS = 30
+# Upload each image to Telegram once and then resend it by its file_id
+# (stored in the telegram_files table)
+TELEGRAM_FILE_ID_CACHE = True
 
 
 # Database setup
 DB_SQLALCHEMY_CONNECTION = 'sqlite:///poshan_didi.db'
+# Store users.current_state as a small integer (via the state_ids table)
+# rather than a UUID string. Only turn this on for a new database: the bot
+# refuses to start if it doesn't match how the database was created.
+DB_INTEGER_STATE_IDS = False
+# Connection pool (ignored for SQLite). Each thread that is talking to the
+# database holds one connection.
+DB_POOL_SIZE = 5
+DB_POOL_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT_SECONDS = 30
+DB_POOL_RECYCLE_SECONDS = 1800
+# Set on every SQLite connection. WAL lets the API read while the bot is
+# writing, and with synchronous=NORMAL commits don't wait for an fsync (a
+# crash can lose the last few commits but won't corrupt the database).
+DB_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+}
+# With PostgreSQL (psycopg2), write batches of logged messages with COPY
+# rather than INSERTs
+DB_POSTGRES_COPY = True
+# Logged messages are written in batches by a background thread: whenever
+# this many are waiting, or every MESSAGE_LOG_FLUSH_SECONDS. Set the batch
+# size to 0 to write each message immediately (e.g. for tests).
+MESSAGE_LOG_BATCH_SIZE = 50
+MESSAGE_LOG_FLUSH_SECONDS = 1.0
+# While the database can't be written, keep at most this many messages
+# (dropping the oldest)
+MESSAGE_LOG_MAX_PENDING = 10000
+# Recently used users rows are cached in memory (0 = no cache). Changes made
+# by another process (the bot vs. the WhatsApp app) are only seen once a
+# cached row is older than USER_CACHE_SECONDS.
+USER_CACHE_SIZE = 10000
+USER_CACHE_SECONDS = 30
+# Cohort commands work through the users this many at a time, committing
+# after each chunk
+DB_CHUNK_SIZE = 100
+# Move messages older than this many days out of the messages table into
+# per-month archive tables, once a day (0 = never). `python db.py archive`
+# does the same by hand.
+MESSAGE_ARCHIVE_AFTER_DAYS = 0
+# How long the list of archive tables is cached for the message history
+# API. Archived messages can be missing from it for up to this long.
+MESSAGE_ARCHIVE_TABLES_CACHE_SECONDS = 300
 
 
 # NLU threshold -- NLP engine must have confidence above threshold to
 # return an intent
 NLU_THRESHOLD = 0.4
+# Which model get_rasa_intent uses: 'rasa' (nlu_config.yml, needs
+# TensorFlow) or 'ngram' (ngram_nlu.py, needs only NumPy)
+NLU_CLASSIFIER = 'rasa'
+NLU_NGRAM_MODEL = os.path.join('models', 'ngram-nlu.npz')
+# The n-gram model's top intent must beat the runner-up by this much
+# (otherwise the message goes to the nurse)
+NLU_NGRAM_MIN_MARGIN = 0.2
+# The model is only loaded when get_rasa_intent is first used. Set this
+# to start loading it in the background when the bot starts instead.
+NLU_PRELOAD_RASA = False
+# Run the model above in this many worker processes instead of inline
+# (0 = inline). Concurrent requests are batched together, and any that take
+# longer than the timeout are treated as unknown input.
+NLU_SERVICE_WORKERS = 0
+NLU_SERVICE_BATCH_SIZE = 16
+NLU_SERVICE_BATCH_WAIT_MS = 5
+NLU_SERVICE_TIMEOUT_SECONDS = 2.0
+# Typo tolerance for the dictionary-based intents: the maximum edit distance
+# (0 turns it off) and the shortest input that is matched fuzzily. Inputs
+# shorter than NLU_FUZZY_EDIT_LENGTH only match with two letters swapped or
+# one doubled ("tow", "yess"), since other edits turn everyday words into
+# numbers ("for" -> four, "nice" -> nine). Longer inputs may have any edits
+# except to their first or last letter.
+NLU_FUZZY_MAX_DISTANCE = 1
+NLU_FUZZY_MIN_LENGTH = 3
+NLU_FUZZY_EDIT_LENGTH = 5
 
 # State machine files
 FLOW_6_MONTHS = os.path.join('data', 'poshan-didi-6months.json')
@@ -32,6 +117,25 @@ TRANSLATIONS_12_MONTHS = os.path.join(
     'data', 'poshan-didi-translations-12months.csv')
 GM_FOLDER = os.path.join('data', 'gm')
 
+# Age tracks: track -> (flow, translations). Users on a track that is not
+# listed here get DEFAULT_TRACK.
+STATE_MACHINE_TRACKS = {
+    '6': (FLOW_6_MONTHS, TRANSLATIONS_6_MONTHS),
+    '12': (FLOW_12_MONTHS, TRANSLATIONS_12_MONTHS),
+}
+DEFAULT_TRACK = '6'
+# Tracks are loaded on first use. To save memory, cap how many stay loaded
+# and/or drop ones that have not been used for a while (0 = no limit). Idle
+# tracks are looked for every CONTENT_RELOAD_INTERVAL_SECONDS.
+STATE_MACHINE_MAX_LOADED = 0
+STATE_MACHINE_IDLE_EVICT_SECONDS = 0
+# Compiled state machine snapshots (rebuilt automatically when the flows or
+# translations above change)
+STATE_MACHINE_CACHE_DIR = os.path.join('data', 'cache')
+# How often to check the files above for changes and reload them without a
+# restart. Set to 0 to disable (the GOD mode /reload command still works).
+CONTENT_RELOAD_INTERVAL_SECONDS = 60
+
 # MODULE details
 MAX_MODULE_6 = 7
 MAX_MODULE_12 = 8
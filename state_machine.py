@@ -1,26 +1,66 @@
+from bisect import bisect_left
+from collections import OrderedDict
 import csv
+import hashlib
 import json
+import logging
+import os
+import pickle
 import re
+import sys
+import tempfile
+import threading
+import time
 
 from simple_settings import settings
+from util import Singleton
+
+logger = logging.getLogger(__name__)
 
 UUID_RE = re.compile(
     r'^[\da-f]{8}-[\da-f]{4}-[\da-f]{4}-[\da-f]{4}-[\da-f]{12}$')
 
+# Bump this whenever the attributes of StateMachine or Node change so old
+# snapshots are thrown away instead of being unpickled into the wrong shape.
+SNAPSHOT_VERSION = 4
+
+# Keys for the precomputed message bundles: English is gender neutral, Hindi
+# has separate male and female variants.
+LANGUAGE_KEYS = ('en', 'M', 'F')
+
 
 class Node():
-    def __init__(self, type, uuid, destination_uuid=None, state_name=None, transitions={}):
+    # There are a few hundred of these per flow and every worker holds both
+    # flows, so keep them compact: no per-instance __dict__, interned ids and
+    # the message lists are frozen into tuples once loading is done.
+    __slots__ = ('type', 'uuid', 'destination_uuid', 'state_name',
+                 'transitions', 'terminal', 'immediate', 'msgs_hi_male',
+                 'msgs_hi_female', 'msgs_en', 'images', 'chain_destination',
+                 'bundles')
+
+    def __init__(self, type, uuid, destination_uuid=None, state_name=None, transitions=None):
         self.type = type
-        self.uuid = uuid
-        self.destination_uuid = destination_uuid
-        self.state_name = state_name
-        self.transitions = transitions
+        self.uuid = _intern(uuid)
+        self.destination_uuid = _intern(destination_uuid)
+        self.state_name = _intern(state_name)
+        self.transitions = transitions if transitions is not None else {}
         self.terminal = False
         self.immediate = False
         self.msgs_hi_male = []
         self.msgs_hi_female = []
         self.msgs_en = []
         self.images = []
+        # Filled in by StateMachine._flatten_immediate_chains once all the
+        # content is loaded: where a chain of immediate states starting here
+        # ends up, and the messages/images for the whole chain per language.
+        self.chain_destination = self
+        self.bundles = {}
+
+    def freeze(self):
+        self.msgs_hi_male = tuple(self.msgs_hi_male)
+        self.msgs_hi_female = tuple(self.msgs_hi_female)
+        self.msgs_en = tuple(self.msgs_en)
+        self.images = tuple(self.images)
 
     def add_hi_msg(self, msg, msg_male=None, msg_female=None):
         msg_male = msg_male or msg
@@ -36,17 +76,28 @@ class Node():
             self.images.append(img)
 
     def get_messages_and_images(self, gender):
-        # default to english
-        msgs = self.msgs_en
-        if settings.HINDI:
-            if gender == 'M':
-                msgs = self.msgs_hi_male
-            elif gender == 'F':
-                msgs = self.msgs_hi_female
-            else:
-                raise ValueError(
-                    f'Gender: "{gender}" unrecognized. Should be M or F')
-        return msgs, self.images
+        return self.get_messages(language_key(gender)), self.images
+
+    def get_messages(self, key):
+        if key == 'M':
+            return self.msgs_hi_male
+        elif key == 'F':
+            return self.msgs_hi_female
+        return self.msgs_en
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def language_key(gender):
+    # default to english
+    if not settings.HINDI:
+        return 'en'
+    if gender in ('M', 'F'):
+        return gender
+    raise ValueError(
+        f'Gender: "{gender}" unrecognized. Should be M or F')
 
 
 class StateMachine(object):
@@ -59,11 +110,53 @@ class StateMachine(object):
 
         self.root_uuid = None
         self.states = []
+        # Indexes over self.nodes and self.states so lookups don't have to
+        # scan the whole flow. These are rebuilt whenever the flow is loaded.
+        self.nodes_by_uuid = {}
+        self.states_by_uuid = {}
+        self.states_by_name = {}
+        self.sorted_state_names = []
         self.load_state_machine(flow_filename, messages_filename)
 
     def load_state_machine(self, flow_filename, messages_filename):
         self._load_flows(flow_filename)
         self._load_messages(messages_filename)
+        self._flatten_immediate_chains()
+
+    @classmethod
+    def load_cached(cls, flow_filename, messages_filename, cache_dir=None):
+        """Return a StateMachine for the given files, using a compiled
+        snapshot in cache_dir when it is still fresh. The snapshot is
+        rebuilt (and rewritten) whenever either source file changes."""
+        cache_dir = cache_dir or settings.STATE_MACHINE_CACHE_DIR
+        snapshot_filename = _snapshot_filename(
+            cache_dir, flow_filename, messages_filename)
+        sources = [flow_filename, messages_filename]
+        fingerprints = [_fingerprint(f) for f in sources]
+
+        snapshot = _read_snapshot(snapshot_filename)
+        if snapshot is not None:
+            if snapshot['fingerprints'] == fingerprints:
+                return cls._from_snapshot(snapshot)
+            # mtime changed (e.g. a fresh checkout), but the content may not have
+            hashes = [_content_hash(f) for f in sources]
+            if snapshot['hashes'] == hashes:
+                _write_snapshot(snapshot_filename, fingerprints,
+                                hashes, snapshot['state'])
+                return cls._from_snapshot(snapshot)
+
+        logger.info(
+            f'Compiling state machine from {flow_filename} and {messages_filename}')
+        sm = cls(flow_filename, messages_filename)
+        _write_snapshot(snapshot_filename, fingerprints,
+                        [_content_hash(f) for f in sources], sm.__dict__)
+        return sm
+
+    @classmethod
+    def _from_snapshot(cls, snapshot):
+        sm = cls.__new__(cls)
+        sm.__dict__.update(snapshot['state'])
+        return sm
 
     def get_start_state(self):
         return self._find_state_by_uuid(self.root_uuid)
@@ -76,6 +169,7 @@ class StateMachine(object):
             intent = str(int(intent))
 
         state_name, state_id, terminal = None, None, True
+        msgs, imgs = [], []
 
         if current_state_id is None:
             next_state = self.get_start_state()
@@ -97,18 +191,12 @@ class StateMachine(object):
             else:
                 next_state = None
 
-            # Loop through all the auto-state transitions
-            msgs, imgs = [], []
-            if next_state is not None:
-                msgs, imgs = self._get_msgs_and_imgs_from_state_name(
-                    next_state.state_name, gender)
-                while next_state is not None and next_state.immediate:
-                    next_state = self._find_state_by_uuid(
-                        next_state.destination_uuid)
-                    m, i = self._get_msgs_and_imgs_from_state_name(
-                        next_state.state_name, gender)
-                    msgs = msgs + m
-                    imgs = imgs + i
+        # The auto-state transitions were followed at load time, so this is
+        # just a lookup of the whole chain's content.
+        if next_state is not None:
+            msgs, imgs = next_state.bundles[language_key(gender)]
+            msgs, imgs = list(msgs), list(imgs)
+            next_state = next_state.chain_destination
 
         if next_state:
             state_name = next_state.state_name
@@ -125,7 +213,7 @@ class StateMachine(object):
             return node.uuid
         raise ValueError(f'Unknown state name {state_name}')
 
-    def _get_msgs_and_imgs_from_state_name(self, state_name, gender):
+    def _get_msgs_and_imgs_from_state_name(self, state_name, key):
         if state_name is None:
             return [], []
 
@@ -133,7 +221,49 @@ class StateMachine(object):
             return [state_name], [state_name]
 
         state = self._find_state_by_name(state_name)
-        return state.get_messages_and_images(gender)
+        return state.get_messages(key), state.images
+
+    def _flatten_immediate_chains(self):
+        for state in self.states:
+            chain = [state]
+            while chain[-1].immediate:
+                dest = self._find_state_by_uuid(chain[-1].destination_uuid)
+                if dest in chain:
+                    raise ValueError(
+                        f'Immediate states loop back on themselves from "{state.state_name}"')
+                chain.append(dest)
+
+            state.chain_destination = chain[-1]
+            state.bundles = {}
+            for key in LANGUAGE_KEYS:
+                msgs, imgs = [], []
+                for s in chain:
+                    m, i = self._get_msgs_and_imgs_from_state_name(
+                        s.state_name, key)
+                    msgs.extend(m)
+                    imgs.extend(i)
+                bundle = (tuple(msgs), tuple(imgs))
+                # Most content has no gender variants, so share the tuples
+                for other in state.bundles.values():
+                    if other == bundle:
+                        bundle = other
+                        break
+                state.bundles[key] = bundle
+
+        for n in self.nodes:
+            n.freeze()
+
+    def get_state_ids(self):
+        """All of the state ids a user can be in for this flow."""
+        return list(self.states_by_uuid)
+
+    def get_all_messages(self):
+        """Every distinct message (in every language) in this flow."""
+        msgs = set()
+        for state in self.states:
+            for key in LANGUAGE_KEYS:
+                msgs.update(state.get_messages(key))
+        return msgs
 
     def _add_content_to_state(self, state_name, msg_en, msg_hi, msg_hi_m, msg_hi_f, image):
         msg_hi_m = msg_hi_m if len(msg_hi_m) > 0 else None
@@ -203,10 +333,29 @@ class StateMachine(object):
                     rule_set['uuid'],
                     transitions=transitions
                 ))
+
+        # Index the nodes (first one wins, as with the old linear scan) and
+        # collapse parent chains so every lookup is a single dict hit.
+        self.nodes_by_uuid = {}
+        for n in self.nodes:
+            self.nodes_by_uuid.setdefault(n.uuid, n)
+        self._resolve_parent_map()
         self._create_states()
 
+    def _resolve_parent_map(self):
+        resolved = {}
+        for uuid in self.parent_map:
+            target, seen = uuid, set()
+            while target in self.parent_map and target not in seen:
+                seen.add(target)
+                target = self.parent_map[target]
+            resolved[uuid] = target
+        self.parent_map = resolved
+
     def _create_states(self):
         self.states = []
+        self.states_by_uuid = {}
+        self.states_by_name = {}
         for n in self.nodes:
             if n.type == 'transition':
                 continue
@@ -225,30 +374,183 @@ class StateMachine(object):
                 n.destination_uuid = dest.uuid
 
             self.states.append(n)
+            self.states_by_uuid.setdefault(n.uuid, n)
+            self.states_by_name.setdefault(n.state_name, n)
+
+        self.sorted_state_names = sorted(self.states_by_name)
 
     def _find_node_by_uuid(self, uuid):
-        if uuid in self.parent_map.keys():
-            return self._find_node_by_uuid(self.parent_map[uuid])
-        for n in self.nodes:
-            if n.uuid == uuid:
-                return n
-        return None
+        return self.nodes_by_uuid.get(self.parent_map.get(uuid, uuid))
 
     def _find_state_by_uuid(self, uuid):
-        for s in self.states:
-            if s.uuid == uuid:
-                return s
-        return None
+        return self.states_by_uuid.get(uuid)
 
     def _find_state_by_name(self, state_name):
-        for s in self.states:
-            if s.state_name == state_name:
-                return s
-        return None
+        return self.states_by_name.get(state_name)
 
     def get_submodule_state_name(self, prefix):
         # Take advantage of our naming scheme to find the correct submodule menu.
-        options = [state.state_name for state in self.states
-                   if state.state_name.startswith(prefix)]
-        options.sort()
-        return options[-1]
+        # Every name starting with prefix sorts before the first string that
+        # is "one past" the prefix, so the last match sits right before it.
+        names = self.sorted_state_names
+        if not prefix:
+            return names[-1]
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        idx = bisect_left(names, upper) - 1
+        if idx < 0 or not names[idx].startswith(prefix):
+            raise IndexError(f'No state name starts with "{prefix}"')
+        return names[idx]
+
+
+#################################################
+# Registry
+#################################################
+class StateMachineRegistry(metaclass=Singleton):
+    """Hands out the StateMachine for each track in
+    settings.STATE_MACHINE_TRACKS, loading it the first time it is asked
+    for. Every module shares the same instance, so a track is only ever
+    loaded once per process.
+
+    Set prepare to a function (track, sm) to validate a machine before it
+    is handed out; raising from it stops the machine being used."""
+
+    def __init__(self):
+        self.prepare = None
+        self._lock = threading.Lock()
+        # track -> StateMachine, least recently used first
+        self._machines = OrderedDict()
+        self._last_used = {}
+
+    def _track_key(self, track):
+        key = str(int(track))
+        if key not in settings.STATE_MACHINE_TRACKS:
+            return settings.DEFAULT_TRACK
+        return key
+
+    def _load(self, key):
+        flow_filename, messages_filename = settings.STATE_MACHINE_TRACKS[key]
+        sm = StateMachine.load_cached(flow_filename, messages_filename)
+        if self.prepare:
+            self.prepare(key, sm)
+        return sm
+
+    def get(self, track):
+        key = self._track_key(track)
+        with self._lock:
+            sm = self._machines.get(key)
+            if sm is None:
+                logger.info(f'Loading state machine for track {key}')
+                sm = self._machines[key] = self._load(key)
+                self._trim()
+            self._machines.move_to_end(key)
+            self._last_used[key] = time.monotonic()
+            return sm
+
+    def loaded_tracks(self):
+        with self._lock:
+            return list(self._machines)
+
+    def source_files(self):
+        """Every file the configured tracks are built from."""
+        return [f for files in settings.STATE_MACHINE_TRACKS.values()
+                for f in files]
+
+    def reload(self):
+        """Rebuild every loaded track from disk and swap them all in at
+        once. If any of them fails, the exception propagates and the old
+        machines stay in place."""
+        new_machines = {key: self._load(key) for key in self.loaded_tracks()}
+        with self._lock:
+            self._machines.update(new_machines)
+
+    def evict(self, track):
+        with self._lock:
+            key = self._track_key(track)
+            self._machines.pop(key, None)
+            self._last_used.pop(key, None)
+
+    def evict_idle(self, max_idle_seconds):
+        """Drop tracks nobody has asked for in max_idle_seconds. They are
+        loaded again (from the snapshot) the next time they are needed."""
+        cutoff = time.monotonic() - max_idle_seconds
+        with self._lock:
+            for key, last_used in list(self._last_used.items()):
+                if last_used < cutoff:
+                    logger.info(f'Evicting idle state machine for track {key}')
+                    self._machines.pop(key, None)
+                    self._last_used.pop(key, None)
+
+    def _trim(self):
+        # Called with the lock held
+        while settings.STATE_MACHINE_MAX_LOADED and \
+                len(self._machines) > settings.STATE_MACHINE_MAX_LOADED:
+            key, _ = self._machines.popitem(last=False)
+            self._last_used.pop(key, None)
+            logger.info(f'Evicting state machine for track {key}')
+
+
+#################################################
+# Compiled snapshots
+#################################################
+def _snapshot_filename(cache_dir, flow_filename, messages_filename):
+    flow_name = os.path.splitext(os.path.basename(flow_filename))[0]
+    messages_name = os.path.splitext(os.path.basename(messages_filename))[0]
+    return os.path.join(cache_dir, f'{flow_name}.{messages_name}.smcache')
+
+
+def _fingerprint(filename):
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _content_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _read_snapshot(snapshot_filename):
+    try:
+        with open(snapshot_filename, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.warning(
+            f'Unable to read state machine snapshot {snapshot_filename}, rebuilding')
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def _write_snapshot(snapshot_filename, fingerprints, hashes, state):
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'fingerprints': fingerprints,
+        'hashes': hashes,
+        'state': state,
+    }
+    cache_dir = os.path.dirname(snapshot_filename)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temp file and rename so other workers never read a
+        # half-written snapshot.
+        fd, tmp_filename = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, snapshot_filename)
+    except OSError:
+        # The cache is an optimisation, never a reason to fail startup
+        logger.warning(
+            f'Unable to write state machine snapshot {snapshot_filename}')
+
+
+def compile_state_machines():
+    """Bring the snapshot for every configured flow up to date."""
+    for flow_filename, messages_filename in settings.STATE_MACHINE_TRACKS.values():
+        StateMachine.load_cached(flow_filename, messages_filename)
+        print(f'Compiled {flow_filename} + {messages_filename}')
+
+
+if __name__ == '__main__':
+    compile_state_machines()